@@ -1,326 +1,126 @@
-import base64
 import os
-import re
-import time
 
-import azure.cognitiveservices.speech as speechsdk
 import gradio as gr
-import openai
 from dotenv import load_dotenv
 
-load_dotenv()
-openai.api_key = os.environ.get("OPENAI_API_KEY")
-
-SYSTEM_DESCRIPTION_EN = """You are an experienced English teacher.
-You are teaching English through a dialog with the student.
-Your response should be at the same level of fluency as the student.
-If the student is a beginner, your response should be simple and short.
-If the student is an advanced English speaker, your response may be elaborate and long.
-"""
+from utils.conversation import Conversation
+from utils.media import media_store
+from utils.metrics import first_audio, speech_ended, timed_stream
+from utils.openai import CHAT_BACKEND, SYSTEM_DESCRIPTION_DICT, stream_chat
+from utils.pipeline import speak_while_streaming
+from utils.speech import (
+    STOP_MIC_JS,
+    admit,
+    audio_src,
+    drop_recording,
+    listen,
+    play_audio,
+    speech_recognize_continuous_from_file,
+    staged_stream,
+    start_listening,
+    stop_listening,
+    synthesize_file,
+    warm_up,
+)
+from utils.sessions import remember_session_js, restore_session_js, session_store
+from utils.stages import QUEUE_CONCURRENCY, STATUS_INTERVAL, backpressure
 
-SYSTEM_DESCRIPTION_SV = """Du är en erfaren lärare i svenska.
-Du lär ut svenska genom en dialog med eleven.
-Ditt svar bör vara på samma nivå som elevens.
-Om eleven är nybörjare bör ditt svar vara enkelt och kort.
-Om eleven är en avancerad svensktalare kan ditt svar vara utförligt och långt.
-"""
-
-SYSTEM_DESCRIPTION_JP = """あなたは経験豊富な日本語教師です。
-あなたは生徒との対話を通して日本語を教えます。
-あなたの返答は、生徒と同じレベルの流暢さでなければなりません。
-もし生徒が初心者であれば、あなたの返答はシンプルで短いものであるべきです。
-もし生徒が日本語上級者であれば、あなたの返答は詳細で長くてもよいです。
-"""
-
-SYSTEM_DESCRIPTION_DICT = {
-    "en-US": SYSTEM_DESCRIPTION_EN,
-    "en-GB": SYSTEM_DESCRIPTION_EN,
-    "sv-SE": SYSTEM_DESCRIPTION_SV,
-    "ja-JP": SYSTEM_DESCRIPTION_JP,
-}
+load_dotenv()
 
-SPEECH_DICT = {
-    "en-US": "en-US-JennyNeural",
-    "en-GB": "en-GB-SoniaNeural",
-    "sv-SE": "sv-SE-SofieNeural",
-    "ja-JP": "ja-JP-NanamiNeural",
+# transcribe while the student talks instead of after the recording stops
+STREAMING_ASR = os.environ.get("STREAMING_ASR", "1") == "1"
+
+
+def resume_session(session_id: str) -> list:
+    """the session this browser had, if the server still has it, or a new one"""
+    session_id = session_store.resume(session_id)
+    return [session_id, session_store.history(session_id)]
+
+
+def user(audio: str, text: str, language: str, session_id: str) -> gr.Chatbot:
+    with session_store.use(session_id) as session:
+        if session.conversation is None:
+            session.conversation = Conversation(
+                SYSTEM_DESCRIPTION_DICT[language], language
+            )
+        session.conversation.add_user(text)
+        player = play_audio(audio, session_id=session_id)
+        session.history.append([text + "\n\n" + player, None])
+        return session.history
+
+
+async def bot(language: str, session_id: str):
+    """streams the reply and speaks it sentence by sentence while it is generated"""
+
+    async def speak(sentence: str) -> str | None:
+        # a sentence without audio is better than losing the whole reply
+        try:
+            return await synthesize_file(sentence, language, session_id, admitted=True)
+        except gr.Error as e:
+            print(f"Could not speak [{sentence}]: {e}")
+
+    # the reply is spoken as a whole or not at all, never with gaps
+    admit("tts")
+    async with session_store.use_async(session_id) as session:
+        history, conversation = session.history, session.conversation
+        conversation.system = SYSTEM_DESCRIPTION_DICT[language]
+        messages = conversation.messages()
+
+        history[-1][1] = ""
+        spoken = []
+        deltas = timed_stream(
+            staged_stream("llm", stream_chat(messages, temperature=0.8)),
+            session_id=session_id,
+            language=language,
+            backend=CHAT_BACKEND,
+        )
+        async for delta, output_path in speak_while_streaming(deltas, speak):
+            if delta:
+                history[-1][1] += delta
+                yield history, gr.update()
+            elif output_path:
+                if not spoken:
+                    first_audio(session_id, language)
+                spoken.append(output_path)
+                yield history, audio_src(output_path)
+        conversation.add_assistant(history[-1][1])
+
+        # the sentences have already been played by the speaker, keep them for replay
+        history[-1][1] += "\n\n" + "".join(
+            play_audio(output_path, autoplay=False) for output_path in spoken
+        )
+        yield history, gr.update()
+
+
+def clear_conversation(session_id: str) -> gr.Chatbot:
+    media_store.spool.release_session(session_id)
+    session_store.clear(session_id)
+    return []
+
+
+# plays the sentences of a reply one after another as their audio arrives
+SPEAKER_JS = """
+() => {
+    const queue = [];
+    let playing = false;
+    const playNext = () => {
+        if (playing || queue.length === 0) return;
+        playing = true;
+        const audio = new Audio(queue.shift());
+        audio.onended = audio.onerror = () => {
+            playing = false;
+            playNext();
+        };
+        audio.play().catch(audio.onended);
+    };
+    window.talkEnqueueAudio = (src) => {
+        if (src) {
+            queue.push(src);
+            playNext();
+        }
+    };
 }
-
-# def recognize_from_file(audio: str, language: str) -> str:
-#     speech_config = speechsdk.SpeechConfig(
-#         subscription=os.environ.get("SPEECH_KEY"),
-#         region=os.environ.get("SPEECH_REGION"),
-#     )
-#     audio_config = speechsdk.audio.AudioConfig(filename=audio)
-#     speech_recognizer = speechsdk.SpeechRecognizer(
-#         speech_config=speech_config, audio_config=audio_config, language=language
-#     )
-
-#     speech_recognition_result = speech_recognizer.recognize_once_async().get()
-
-#     if speech_recognition_result.reason == speechsdk.ResultReason.RecognizedSpeech:
-#         print(f"Recognized: {speech_recognition_result.text}")
-#         return speech_recognition_result.text
-#     elif speech_recognition_result.reason == speechsdk.ResultReason.NoMatch:
-#         print(
-#             f"No speech could be recognized: {speech_recognition_result.no_match_details}"
-#         )
-#         return ""
-#     elif speech_recognition_result.reason == speechsdk.ResultReason.Canceled:
-#         cancellation_details = speech_recognition_result.cancellation_details
-#         print(f"Speech Recognition canceled: {cancellation_details.reason}")
-#         if cancellation_details.reason == speechsdk.CancellationReason.Error:
-#             print(f"Error details: {cancellation_details.error_details}")
-#             print("Did you set the speech resource key and region values?")
-#         return ""
-
-
-def speech_recognize_continuous_from_file(audio: str, language: str) -> str:
-    """performs continuous speech recognition with input from an audio file"""
-    # <SpeechContinuousRecognitionWithFile>
-    speech_config = speechsdk.SpeechConfig(
-        subscription=os.environ.get("SPEECH_KEY"),
-        region=os.environ.get("SPEECH_REGION"),
-    )
-    audio_config = speechsdk.audio.AudioConfig(filename=audio)
-
-    speech_recognizer = speechsdk.SpeechRecognizer(
-        speech_config=speech_config, audio_config=audio_config, language=language
-    )
-
-    done = False
-    recognized_text = ""
-
-    def recognized(evt):
-        print(f"RECOGNIZED: {evt}")
-        nonlocal recognized_text
-        recognized_text += evt.result.text
-
-    def stop_cb(evt):
-        """callback that signals to stop continuous recognition upon receiving an event `evt`"""
-        print("CLOSING on {}".format(evt))
-        nonlocal done
-        done = True
-
-    # Connect callbacks to the events fired by the speech recognizer
-    # speech_recognizer.recognizing.connect(lambda evt: print('RECOGNIZING: {}'.format(evt)))
-    speech_recognizer.recognized.connect(recognized)
-    speech_recognizer.session_started.connect(
-        lambda evt: print("SESSION STARTED: {}".format(evt))
-    )
-    speech_recognizer.session_stopped.connect(
-        lambda evt: print("SESSION STOPPED {}".format(evt))
-    )
-    speech_recognizer.canceled.connect(lambda evt: print("CANCELED {}".format(evt)))
-    # stop continuous recognition on either session stopped or canceled events
-    speech_recognizer.session_stopped.connect(stop_cb)
-    speech_recognizer.canceled.connect(stop_cb)
-
-    # Start continuous speech recognition
-    speech_recognizer.start_continuous_recognition()
-    while not done:
-        time.sleep(0.5)
-
-    speech_recognizer.stop_continuous_recognition()
-
-    return recognized_text
-
-
-def play_audio(file_path: str):
-    print(file_path)
-    with open(file_path, "rb") as f:
-        audio_bytes = f.read()
-
-    audio = base64.b64encode(audio_bytes).decode("utf-8")
-    audio_player = (
-        f'<audio src="data:audio/mpeg;base64,{audio}" controls autoplay></audio>'
-    )
-
-    return audio_player
-
-
-def to_sppech(audio: str, history: gr.Chatbot, lang: str) -> gr.Chatbot:
-    output_path = audio.replace(".wav", "output.wav")
-    speech_config = speechsdk.SpeechConfig(
-        subscription=os.environ.get("SPEECH_KEY"),
-        region=os.environ.get("SPEECH_REGION"),
-    )
-    audio_config = speechsdk.audio.AudioOutputConfig(filename=output_path)
-    speech_config.speech_synthesis_voice_name = SPEECH_DICT[lang]
-
-    speech_synthesizer = speechsdk.SpeechSynthesizer(
-        speech_config=speech_config, audio_config=audio_config
-    )
-
-    text = history[-1][1]
-    speech_synthesis_result = speech_synthesizer.speak_text_async(text).get()
-
-    if (
-        speech_synthesis_result.reason
-        == speechsdk.ResultReason.SynthesizingAudioCompleted
-    ):
-        print("Speech synthesized for text [{}]".format(text))
-        history[-1][1] += "\n\n" + play_audio(output_path)
-        return history
-    elif speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
-        cancellation_details = speech_synthesis_result.cancellation_details
-        print("Speech synthesis canceled: {}".format(cancellation_details.reason))
-        if cancellation_details.reason == speechsdk.CancellationReason.Error:
-            if cancellation_details.error_details:
-                print("Error details: {}".format(cancellation_details.error_details))
-                print("Did you set the speech resource key and region values?")
-
-
-# # https://github.com/Azure-Samples/cognitive-services-speech-sdk/blob/513c0d8e4370f47dcf241c0682265c2b2fa37db6/samples/python/console/speech_sample.py
-# def speech_recognition_with_pull_stream(audio: str, language: str):
-#     """gives an example how to use a pull audio stream to recognize speech from a custom audio
-#     source"""
-
-#     class WavFileReaderCallback(speechsdk.audio.PullAudioInputStreamCallback):
-#         """Example class that implements the Pull Audio Stream interface to recognize speech from
-#         an audio file"""
-
-#         def __init__(self, filename: str):
-#             super().__init__()
-#             self._file_h = wave.open(filename, mode=None)
-
-#             self.sample_width = self._file_h.getsampwidth()
-
-#             assert self._file_h.getnchannels() == 1
-#             assert self._file_h.getsampwidth() == 2
-#             assert self._file_h.getframerate() == 48000
-#             assert self._file_h.getcomptype() == "NONE"
-
-#         def read(self, buffer: memoryview) -> int:
-#             """read callback function"""
-#             size = buffer.nbytes
-#             frames = self._file_h.readframes(size // self.sample_width)
-
-#             buffer[: len(frames)] = frames
-
-#             return len(frames)
-
-#         def close(self):
-#             """close callback function"""
-#             self._file_h.close()
-
-#     speech_config = speechsdk.SpeechConfig(
-#         subscription=os.environ.get("SPEECH_KEY"),
-#         region=os.environ.get("SPEECH_REGION"),
-#     )
-
-#     # specify the audio format
-#     wave_format = speechsdk.audio.AudioStreamFormat(
-#         samples_per_second=48000, bits_per_sample=16, channels=1
-#     )
-
-#     # setup the audio stream
-#     callback = WavFileReaderCallback(audio)
-#     stream = speechsdk.audio.PullAudioInputStream(callback, wave_format)
-#     audio_config = speechsdk.audio.AudioConfig(stream=stream)
-
-#     # instantiate the speech recognizer with pull stream input
-#     speech_recognizer = speechsdk.SpeechRecognizer(
-#         speech_config=speech_config, audio_config=audio_config, language=language
-#     )
-
-#     done = False
-#     recognized_text = ""
-
-#     def recognized(evt):
-#         print(f"RECOGNIZED: {evt}")
-#         nonlocal recognized_text
-#         recognized_text += evt.result.text
-
-#     def stop_cb(evt):
-#         """callback that signals to stop continuous recognition upon receiving an event `evt`"""
-#         print("CLOSING on {}".format(evt))
-#         nonlocal done
-#         done = True
-
-#     # Connect callbacks to the events fired by the speech recognizer
-#     # speech_recognizer.recognizing.connect(
-#     #     lambda evt: print("RECOGNIZING: {}".format(evt))
-#     # )
-#     speech_recognizer.recognized.connect(recognized)
-#     speech_recognizer.session_started.connect(
-#         lambda evt: print("SESSION STARTED: {}".format(evt))
-#     )
-#     speech_recognizer.session_stopped.connect(
-#         lambda evt: print("SESSION STOPPED {}".format(evt))
-#     )
-#     speech_recognizer.canceled.connect(lambda evt: print("CANCELED {}".format(evt)))
-#     # stop continuous recognition on either session stopped or canceled events
-#     speech_recognizer.session_stopped.connect(stop_cb)
-#     speech_recognizer.canceled.connect(stop_cb)
-
-#     # Start continuous speech recognition
-#     speech_recognizer.start_continuous_recognition()
-
-#     while not done:
-#         time.sleep(0.5)
-
-#     speech_recognizer.stop_continuous_recognition()
-
-#     return recognized_text
-
-
-# def whisper(audio: str, language: str):
-#     audio_file = open(audio, "rb")
-#     transcript = openai.Audio.transcribe("whisper-1", audio_file, language=language)
-#     return transcript["text"]
-
-
-def compose_messages(history: gr.Chatbot, language: str) -> list[dict[str, str]]:
-    messages = [{"role": "system", "content": SYSTEM_DESCRIPTION_DICT[language]}]
-
-    for t in history:
-        for i, elm in enumerate(t):
-            match i:
-                case i if i % 2 == 0:
-                    messages += [
-                        {
-                            "role": "user",
-                            "content": re.sub(r"\<audio.*\/audio\>", "", elm),
-                        }
-                    ]
-                case i if i % 2 == 1 and elm:
-                    messages += [
-                        {
-                            "role": "assistant",
-                            "content": re.sub(r"\<audio.*\/audio\>", "", elm),
-                        }
-                    ]
-    return messages
-
-
-# def transcribe(audio, lang, state=""):
-#     # text = speech_recognition_with_pull_stream(audio, lang)
-#     # text = whisper(audio, lang)
-#     text = speech_recognize_continuous_from_file(audio, lang)
-#     print(f"text: {text}")
-#     print(f"state: {state}")
-#     if text:
-#         state += text + " "
-#     return state, state
-
-
-def user(audio: str, text: str, history: gr.Chatbot) -> gr.Chatbot:
-    return history + [[text + "\n\n" + play_audio(audio), None]]
-
-
-def bot(history: gr.Chatbot, language: str) -> gr.Chatbot:
-    messages = compose_messages(history, language)
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", messages=messages, temperature=0.8, stream=True
-    )
-
-    history[-1][1] = ""
-    for chunk in response:
-        chunk_message = chunk["choices"][0]["delta"]
-        if "content" in chunk_message:
-            history[-1][1] += chunk_message["content"]
-            yield history
+"""
 
 
 with gr.Blocks() as demo:
@@ -331,40 +131,98 @@ with gr.Blocks() as demo:
             value="ja-JP",
         )
         clear = gr.Button("Clear conversation", size="sm")
+    status = gr.Markdown()
     chatbot = gr.Chatbot()
+    # the only state the browser holds, everything else is in the session store
+    session_id = gr.Textbox(visible=False)
+    speaker = gr.Textbox(visible=False)
+    # the streaming listener, the recording it leaves behind, and a hidden
+    # component that changes when the student stops speaking
+    listener = gr.State(None)
+    recording = gr.State(None)
+    endpoint = gr.Textbox(visible=False)
     with gr.Row():
-        audio = gr.Audio(source="microphone", type="filepath", format="wav")
+        if STREAMING_ASR:
+            audio = gr.Audio(
+                source="microphone", type="numpy", streaming=True, elem_id="microphone"
+            )
+        else:
+            audio = gr.Audio(source="microphone", type="filepath", format="wav")
         text = gr.Textbox(label="Recognized input", interactive=True)
         btn_text = gr.Button("Submit text")
         reset_recording = gr.Button("Clear recording")
 
-    audio.change(
-        speech_recognize_continuous_from_file, [audio, lang], [text], queue=True
-    )
-    btn_text.click(user, [audio, text, chatbot], chatbot, queue=True).success(
-        bot, [chatbot, lang], chatbot, queue=True
-    ).success(to_sppech, [audio, chatbot, lang], chatbot, queue=True).then(
-        lambda: [None, None], None, [audio, text], queue=False
+    submitted = recording if STREAMING_ASR else audio
+
+    def submit_turn(then):
+        then(
+            user,
+            [submitted, text, lang, session_id],
+            chatbot,
+            queue=True,
+        ).success(
+            bot,
+            [lang, session_id],
+            [chatbot, speaker],
+            queue=True,
+        ).then(lambda: [None, None, None], None, [audio, text, recording], queue=False)
+
+    if STREAMING_ASR:
+        audio.start_recording(start_listening, listener, listener, queue=False)
+        audio.stream(
+            listen,
+            [audio, lang, listener],
+            [text, listener, endpoint],
+            queue=True,
+            show_progress=False,
+        )
+        audio.stop_recording(
+            stop_listening,
+            [listener, session_id],
+            [text, recording, listener],
+            queue=True,
+        )
+        # the end of speech stops the microphone and submits the turn
+        submit_turn(
+            endpoint.change(
+                stop_listening,
+                [listener, session_id],
+                [text, recording, listener],
+                queue=True,
+                _js=STOP_MIC_JS,
+            ).success
+        )
+    else:
+        audio.stop_recording(speech_ended, session_id, None, queue=False)
+        audio.change(
+            speech_recognize_continuous_from_file,
+            [audio, lang, session_id],
+            [text],
+            queue=True,
+        )
+    submit_turn(btn_text.click)
+    speaker.change(
+        None, speaker, None, _js="(src) => { window.talkEnqueueAudio(src); return []; }"
     )
 
     reset_recording.click(
-        lambda: [None, None],
+        lambda: [None, None, None],
         None,
-        [audio, text],
+        [audio, text, recording],
         queue=False,
-    )
-    clear.click(lambda: None, None, [chatbot], queue=False)
-
-demo.queue()
-demo.launch(debug=True)
-
-# gr.Interface(
-#     fn=transcribe,
-#     inputs=[
-#         gr.Dropdown(choices=["en-US", "en-GB", "sv-SE", "ja-JP"], value="en-US"),
-#         gr.Audio(source="microphone", type="filepath", format="wav", streaming=True),
-#         "state",
-#     ],
-#     outputs=[gr.Textbox(), "state"],
-#     live=True,
-# ).launch(debug=True)
+    ).then(drop_recording, listener, listener, queue=False)
+    clear.click(clear_conversation, session_id, chatbot, queue=False)
+    demo.load(None, None, None, _js=SPEAKER_JS)
+    demo.load(
+        resume_session,
+        session_id,
+        [session_id, chatbot],
+        queue=False,
+        _js=restore_session_js("talk-conversation"),
+    ).then(None, session_id, None, _js=remember_session_js("talk-conversation"))
+    demo.load(backpressure, None, status, every=STATUS_INTERVAL)
+
+if __name__ == "__main__":
+    warm_up()
+    demo.queue(concurrency_count=QUEUE_CONCURRENCY)
+    demo.launch(debug=True, allowed_paths=media_store.allowed_paths)
@@ -0,0 +1,235 @@
+"""re-grades stored recordings against their reference sentences.
+
+    python grade_batch.py manifest.csv scores.csv --workers 8 --rate 5
+
+The manifest is a CSV (or JSON lines) file with `audio`, `reference_text`
+and `language` fields; relative audio paths are resolved against the
+manifest's directory. Results are appended to the output CSV as they
+arrive, one row per utterance, word and phoneme, so an interrupted run
+picks up where it stopped when started again with the same output.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import os
+import statistics
+import time
+
+from utils.assessment import AssessmentResult, merge_segments
+from utils.audio import prepare
+from utils.speech_backends import backend_for
+
+try:
+    import pyarrow.csv
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FIELDS = [
+    "audio",
+    "reference_text",
+    "language",
+    "level",
+    "index",
+    "word",
+    "phoneme",
+    "accuracy",
+    "error_type",
+    "fluency",
+    "completeness",
+    "pronunciation",
+    "recognized_text",
+    "backend",
+    "seconds",
+]
+
+
+def read_manifest(path: str):
+    root = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding="utf-8") as f:
+        if path.endswith((".jsonl", ".json")):
+            items = (json.loads(line) for line in f if line.strip())
+        else:
+            items = csv.DictReader(f)
+        for item in items:
+            yield {
+                "audio": item["audio"],
+                "path": os.path.join(root, item["audio"]),
+                "reference_text": item["reference_text"],
+                "language": item["language"],
+            }
+
+
+def _key(row: dict) -> tuple:
+    return (row["audio"], row["reference_text"], row["language"])
+
+
+def completed(output: str) -> set[tuple]:
+    """the items already graded in `output`, dropping rows of unfinished ones"""
+    if not os.path.exists(output):
+        return set()
+    with open(output, newline="", encoding="utf-8") as f:
+        rows = list(csv.DictReader(f))
+    # the utterance row is written last, so it marks a finished item
+    done = {_key(r) for r in rows if r["level"] == "utterance" and r["seconds"]}
+    kept = [r for r in rows if _key(r) in done]
+    if len(kept) < len(rows):
+        with open(output, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, FIELDS)
+            writer.writeheader()
+            writer.writerows(kept)
+    return done
+
+
+def result_rows(item: dict, result: AssessmentResult, backend: str, seconds: float):
+    base = {k: item[k] for k in ("audio", "reference_text", "language")}
+    for i, word in enumerate(result.words):
+        for phoneme in word.phonemes:
+            yield {
+                **base,
+                "level": "phoneme",
+                "index": i,
+                "word": word.word,
+                "phoneme": phoneme.phoneme,
+                "accuracy": phoneme.accuracy,
+            }
+        yield {
+            **base,
+            "level": "word",
+            "index": i,
+            "word": word.word,
+            "accuracy": word.accuracy,
+            "error_type": word.error_type,
+        }
+    yield {
+        **base,
+        "level": "utterance",
+        "accuracy": result.accuracy,
+        "fluency": result.fluency,
+        "completeness": result.completeness,
+        "pronunciation": result.pronunciation,
+        "recognized_text": result.recognized_text,
+        "backend": backend,
+        "seconds": round(seconds, 3),
+    }
+
+
+class RateLimiter:
+    """lets at most `rate` calls start per second, spaced evenly"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate else 0
+        self.next_start = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self.next_start - now
+            self.next_start = max(now, self.next_start) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+async def run(args) -> None:
+    done = completed(args.output)
+    new_file = not os.path.exists(args.output)
+    limiter = RateLimiter(args.rate)
+    items: asyncio.Queue = asyncio.Queue(maxsize=args.workers * 2)
+    latencies: list[float] = []
+    failures = 0
+    skipped = 0
+
+    with open(args.output, "a", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, FIELDS)
+        if new_file:
+            writer.writeheader()
+
+        async def worker() -> None:
+            nonlocal failures
+            while (item := await items.get()) is not None:
+                language = item["language"]
+                await limiter.wait()
+                start = time.perf_counter()
+                backend = backend_for("assessment", language)
+                try:
+                    audio = await prepare(item["path"])
+                    # long passages are assessed to the end, segment by segment
+                    segments = [
+                        segment
+                        async for segment in backend.assess_segments(
+                            audio, item["reference_text"], language, args.granularity
+                        )
+                    ]
+                    result_json = merge_segments(
+                        item["reference_text"], segments, language
+                    )
+                    result = AssessmentResult.from_json(
+                        item["reference_text"], result_json
+                    )
+                except Exception as e:
+                    failures += 1
+                    print(f"Could not grade {item['audio']}: {e}")
+                    continue
+                seconds = time.perf_counter() - start
+                latencies.append(seconds)
+                writer.writerows(result_rows(item, result, backend.name, seconds))
+                f.flush()
+
+        started = time.perf_counter()
+        workers = [asyncio.create_task(worker()) for _ in range(args.workers)]
+        for item in read_manifest(args.manifest):
+            if _key(item) in done:
+                skipped += 1
+                continue
+            await items.put(item)
+        for _ in workers:
+            await items.put(None)
+        await asyncio.gather(*workers)
+        elapsed = time.perf_counter() - started
+
+    print(f"Graded {len(latencies)}, failed {failures}, already done {skipped}")
+    if latencies:
+        print(f"Throughput: {len(latencies) / elapsed:.2f} recordings/s")
+    if len(latencies) > 1:
+        p50, p90, p99 = (
+            statistics.quantiles(latencies, n=100, method="inclusive")[i]
+            for i in (49, 89, 98)
+        )
+        print(f"Latency: p50 {p50:.2f} s, p90 {p90:.2f} s, p99 {p99:.2f} s")
+
+    if args.parquet:
+        if pyarrow is None:
+            print("Install pyarrow to write Parquet, the CSV is complete")
+            return
+        table = pyarrow.csv.read_csv(args.output)
+        pyarrow.parquet.write_table(table, args.parquet)
+        print(f"Wrote {table.num_rows} rows to {args.parquet}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "manifest", help="CSV or JSON lines of audio, reference_text, language"
+    )
+    parser.add_argument("output", help="CSV the scores are appended to")
+    parser.add_argument("--parquet", help="also write the finished results here")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="assessments started per second, 0 for no limit",
+    )
+    parser.add_argument(
+        "--granularity", default="Phoneme", choices=["Phoneme", "Word", "FullText"]
+    )
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
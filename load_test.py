@@ -0,0 +1,311 @@
+"""drives the apps' event chains with simulated students to find where they degrade.
+
+    python load_test.py --flow pronunciation --students 50 --turns 5 --audio "rec/*.wav"
+    FAKE_TTS_LATENCY=lognormal:0.4,0.6 python load_test.py --students 200
+
+Every student gets a session and replays recordings through the functions
+the UI events call: recognition, `user` and `bot` for the conversation app;
+grading, `user`, `bot` and the example audio for the pronunciation app.
+Unless --real is given, the speech and chat backends are the fakes, with
+latencies drawn from the FAKE_*_LATENCY distributions (see utils.latency),
+so the numbers show what this process adds. Every replay gets a little
+noise and the fake examples differ, so the assessment and TTS caches miss
+as they would with real students. The browser and the Gradio queue are
+not part of the test.
+
+Prints p50/p95/p99 per stage and per turn, the throughput, the peak queue
+depths and the memory; --timeline and --report write them out so runs can
+be compared.
+"""
+
+import argparse
+import asyncio
+import csv
+import glob
+import importlib
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+# the environment of the fakes, set before the apps read their configuration
+FAKES = {
+    "ASR_BACKENDS": "*=fake",
+    "TTS_BACKENDS": "*=fake",
+    "ASSESSMENT_BACKENDS": "*=fake",
+    "CHAT_BACKEND": "fake",
+}
+
+TOPIC = "Business"
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    # quantiles needs two values, one is its own percentiles anyway
+    quantiles = statistics.quantiles(values * 2, n=100, method="inclusive")
+    return {
+        "count": len(values),
+        "p50": round(quantiles[49], 3),
+        "p95": round(quantiles[94], 3),
+        "p99": round(quantiles[98], 3),
+    }
+
+
+class Recorder:
+    """collects the latencies, failures and samples of one run"""
+
+    def __init__(self):
+        self.seconds: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+        self.timeline: list[dict] = []
+
+    def event(self, event: dict) -> None:
+        """takes the events of utils.metrics, one per stage of every turn"""
+        if "error" in event:
+            self.errors[f"{event['stage']}: {event['error']}"] += 1
+        elif "seconds" in event and not event["stage"].startswith("startup"):
+            self.seconds[event["stage"]].append(event["seconds"])
+
+    @contextmanager
+    def step(self, name: str):
+        start = time.perf_counter()
+        yield
+        self.seconds[f"step_{name}"].append(time.perf_counter() - start)
+
+
+class Students:
+    """the simulated students, sharing one process with the app under test"""
+
+    def __init__(self, args, recorder: Recorder, workdir: str):
+        self.args = args
+        self.recorder = recorder
+        self.workdir = workdir
+        # imported only now, they read the environment set up in main
+        self.audio = importlib.import_module("utils.audio")
+        self.recordings = sorted(
+            path for pattern in args.audio for path in glob.glob(pattern)
+        ) or [self._tone()]
+        self.metrics = importlib.import_module("utils.metrics")
+        self.sessions = importlib.import_module("utils.sessions")
+        self.speech = importlib.import_module("utils.speech")
+        self.app = importlib.import_module(
+            "app" if args.flow == "conversation" else "pronunciation"
+        )
+
+    def _tone(self) -> str:
+        """two seconds of a noisy tone, when no recordings are given"""
+        t = np.arange(32000) / 16000
+        samples = 0.3 * np.sin(2 * np.pi * 220 * t) + 0.01 * np.random.randn(len(t))
+        path = os.path.join(self.workdir, "tone.wav")
+        with open(path, "wb") as f:
+            f.write(self.audio.wav_bytes(self.audio.to_pcm16(samples), 16000))
+        return path
+
+    def recording(self) -> str:
+        """a fresh copy with a little noise of its own, since the media store
+        cleans up what it is given and the caches know every exact copy"""
+        samples, sample_rate = self.audio.read_wav(random.choice(self.recordings))
+        samples = samples + np.random.normal(0, 1e-3, samples.shape)
+        path = os.path.join(self.workdir, f"{random.getrandbits(64):016x}.wav")
+        with open(path, "wb") as f:
+            pcm = self.audio.to_pcm16(samples)
+            f.write(self.audio.wav_bytes(pcm, sample_rate, samples.shape[1]))
+        return path
+
+    async def conversation_turn(self, session_id: str) -> None:
+        language, app = self.args.language, self.app
+        audio = self.recording()
+        with self.recorder.step("recognize"):
+            text = await self.speech.speech_recognize_continuous_from_file(
+                audio, language, session_id
+            )
+        with self.recorder.step("user"):
+            app.user(audio, text, language, session_id)
+        with self.recorder.step("bot"):
+            async for _ in app.bot(language, session_id):
+                pass
+
+    async def pronunciation_turn(self, session_id: str, student: str) -> None:
+        language, app = self.args.language, self.app
+        audio = self.recording()
+        with self.recorder.step("grade"):
+            async for _ in app.grade_attempt(audio, language, session_id):
+                pass
+        with self.recorder.step("user"):
+            await app.user(audio, language, session_id, student)
+        with self.recorder.step("bot"):
+            async for _ in app.bot(TOPIC, language, session_id):
+                pass
+        with self.recorder.step("example"):
+            await app.play_next_example(language, session_id)
+
+    async def student(self, index: int) -> None:
+        args = self.args
+        await asyncio.sleep(index * args.ramp / args.students)
+        session_id = self.sessions.session_store.resume(None)
+        student = f"load-test-{index}"
+        try:
+            if args.flow == "pronunciation":
+                with self.recorder.step("kick_start"):
+                    async for _ in self.app.kick_start(
+                        TOPIC, args.language, session_id, student
+                    ):
+                        pass
+                    await self.app.play_next_example(args.language, session_id)
+        except Exception as e:
+            self.recorder.errors[f"kick_start: {type(e).__name__}: {e}"] += 1
+            return
+        for _ in range(args.turns):
+            start = time.perf_counter()
+            # the turn starts when the student stops speaking
+            self.metrics.speech_ended(session_id, start)
+            try:
+                if args.flow == "pronunciation":
+                    await self.pronunciation_turn(session_id, student)
+                else:
+                    await self.conversation_turn(session_id)
+            except Exception as e:
+                self.recorder.errors[f"turn: {type(e).__name__}: {e}"] += 1
+            else:
+                self.recorder.seconds["turn"].append(time.perf_counter() - start)
+            await asyncio.sleep(random.uniform(0, 2 * args.think))
+
+    async def sample(self, started: float) -> None:
+        stages = importlib.import_module("utils.stages").stages
+        while True:
+            row = {
+                "seconds": round(time.perf_counter() - started, 1),
+                "rss_mb": round(self.metrics.rss_mb(), 1),
+                "sessions_mb": self.sessions.session_store.stats()["memory_mb"],
+            }
+            for name, stage in stages.items():
+                row[f"{name}_active"] = stage.active
+                row[f"{name}_waiting"] = stage.waiting
+            self.recorder.timeline.append(row)
+            await asyncio.sleep(self.args.sample_interval)
+
+
+def summary(args, recorder: Recorder, elapsed: float) -> dict:
+    timeline = recorder.timeline
+    waiting = [key for key in timeline[0] if key.endswith("_waiting")]
+    return {
+        "flow": args.flow,
+        "students": args.students,
+        "turns": len(recorder.seconds["turn"]),
+        "seconds": round(elapsed, 1),
+        "throughput": round(len(recorder.seconds["turn"]) / elapsed, 2),
+        "latency": {
+            stage: percentiles(values)
+            for stage, values in sorted(recorder.seconds.items())
+            if values
+        },
+        "peak_waiting": {
+            key[: -len("_waiting")]: max(row[key] for row in timeline)
+            for key in waiting
+        },
+        "rss_mb": {
+            "start": timeline[0]["rss_mb"],
+            "peak": max(row["rss_mb"] for row in timeline),
+            "end": timeline[-1]["rss_mb"],
+        },
+        "errors": dict(recorder.errors),
+    }
+
+
+def print_summary(report: dict) -> None:
+    print(
+        f"{report['students']} students ({report['flow']}): {report['turns']} "
+        f"turns in {report['seconds']} s, {report['throughput']} turns/s"
+    )
+    print(f"{'stage':<24}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}")
+    for stage, p in report["latency"].items():
+        print(
+            f"{stage:<24}{p['count']:>7}{p['p50']:>9.3f}{p['p95']:>9.3f}"
+            f"{p['p99']:>9.3f}"
+        )
+    peaks = ", ".join(f"{k} {v}" for k, v in report["peak_waiting"].items())
+    print(f"Peak waiting: {peaks}")
+    rss = report["rss_mb"]
+    print(
+        f"RSS: {rss['start']} MB at start, {rss['peak']} MB peak, {rss['end']} MB end"
+    )
+    for error, count in report["errors"].items():
+        print(f"{count} x {error}")
+
+
+async def run(args, workdir: str) -> dict:
+    recorder = Recorder()
+    students = Students(args, recorder, workdir)
+    students.metrics.subscribe(recorder.event)
+    students.speech.warm_up()
+
+    started = time.perf_counter()
+    sampler = asyncio.create_task(students.sample(started))
+    await asyncio.gather(*(students.student(i) for i in range(args.students)))
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    recorder.timeline.append(recorder.timeline[-1] | {"seconds": round(elapsed, 1)})
+
+    if args.timeline:
+        with open(args.timeline, "w", newline="") as f:
+            writer = csv.DictWriter(f, list(recorder.timeline[0]))
+            writer.writeheader()
+            writer.writerows(recorder.timeline)
+    return summary(args, recorder, elapsed)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--flow", default="conversation", choices=["conversation", "pronunciation"]
+    )
+    parser.add_argument("--students", type=int, default=20)
+    parser.add_argument("--turns", type=int, default=5, help="turns per student")
+    parser.add_argument(
+        "--audio",
+        nargs="*",
+        default=[],
+        help="WAV files or globs to replay, a generated tone otherwise",
+    )
+    parser.add_argument("--language", default="en-US")
+    parser.add_argument(
+        "--think", type=float, default=1.0, help="mean seconds between turns"
+    )
+    parser.add_argument(
+        "--ramp", type=float, default=5.0, help="seconds over which students join"
+    )
+    parser.add_argument("--sample-interval", type=float, default=0.5)
+    parser.add_argument("--real", action="store_true", help="use the real backends")
+    parser.add_argument("--timeline", help="CSV of queue depths and memory over time")
+    parser.add_argument("--report", help="JSON summary, to compare runs")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="talk-load-test-")
+    if not args.real:
+        os.environ.update(FAKES)
+    # keep the test's sessions, scores and media away from the real ones
+    os.environ.setdefault("WORD_STORE_PATH", os.path.join(workdir, "word_scores.db"))
+    os.environ.setdefault("SESSION_DIR", os.path.join(workdir, "sessions"))
+    os.environ.setdefault("MEDIA_ROOT", os.path.join(workdir, "media"))
+    os.environ.setdefault("TTS_CACHE_DIR", os.path.join(workdir, "tts_cache"))
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("METRICS_LOG", "")
+
+    try:
+        report = asyncio.run(run(args, workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    print_summary(report)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
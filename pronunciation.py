@@ -1,20 +1,38 @@
-import json
-import os
-import re
+import asyncio
 import time
 
 import gradio as gr
-import openai
+import numpy as np
 from dotenv import load_dotenv
 
-from utils.azure import (
+from utils.conversation import PronunciationConversation
+from utils.media import media_store
+from utils.metrics import timed_stream
+from utils.openai import CHAT_BACKEND, stream_chat
+from utils.pipeline import ExampleDetector
+from utils.speech import (
+    STOP_MIC_JS,
+    Listener,
+    drop_recording,
+    finish_recording,
+    grade,
     grade_pronunciation,
     play_audio,
     play_example,
+    record,
+    staged_stream,
+    start_example,
+    start_listening,
+    warm_up,
 )
+from utils.sessions import remember_session_js, restore_session_js, session_store
+from utils.stages import QUEUE_CONCURRENCY, STATUS_INTERVAL, backpressure
+from utils.word_store import word_store
 
 load_dotenv()
-openai.api_key = os.environ.get("OPENAI_API_KEY")
+
+# seconds after which a teacher reply is cut off
+GENERATION_TIMEOUT = 30
 
 INITIAL_PROMPT = {lang: {} for lang in ["en-US", "ja-JP"]}
 
@@ -82,97 +100,137 @@ def sleep(n_sec: int = 3):
     return
 
 
-def compose_pronunciation_messages(
-    history: gr.Chatbot, topic: str, language: str
-) -> list[dict[str, str]]:
-    messages = [{"role": "system", "content": INITIAL_PROMPT[language][topic]}]
-
-    for t in history:
-        for i, elm in enumerate(t):
-            match i:
-                case i if i % 2 == 0:
-                    user_input = re.sub(r"\<audio.*\/audio\>", "", elm)
-                    messages += [
-                        {
-                            "role": "user",
-                            "content": user_input,
-                        }
-                    ]
-                case i if i % 2 == 1 and elm:
-                    messages += [
-                        {
-                            "role": "assistant",
-                            "content": re.sub(r"\<audio.*\/audio\>", "", elm),
-                        }
-                    ]
-    return messages
-
-
-def user(audio: str, history: gr.Chatbot, language: str) -> gr.Chatbot:
-    grading = json.loads(grade_pronunciation(audio, history, language))
-    grades = [
-        f'{elm["Word"]}: {elm["PronunciationAssessment"]["AccuracyScore"]}'
-        for elm in grading["NBest"][0]["Words"]
-    ]
-    history += [
-        [
-            "Pronunciation score:\n" + "\n".join(grades) + "\n\n" + play_audio(audio),
-            None,
-        ]
-    ]
-    return history
+def student_id(student: str, session_id: str) -> str:
+    # without a name, progress is only kept for this session
+    return student.strip() or session_id
+
+
+def resume_session(session_id: str) -> list:
+    """the session this browser had, if the server still has it, or a new one"""
+    session_id = session_store.resume(session_id)
+    with session_store.use(session_id) as session:
+        started = session.conversation is not None
+        return [session_id, session.history, gr.update(interactive=started)]
+
+
+async def record_attempt(
+    chunk: tuple[int, np.ndarray] | None,
+    language: str,
+    listener: Listener | None,
+    session_id: str,
+) -> list:
+    """like `record`, but the end of speech only submits once practice has started"""
+    listener, endpoint = await record(chunk, language, listener)
+    if isinstance(endpoint, str):
+        async with session_store.use_async(session_id) as session:
+            if session.conversation is None:
+                endpoint = gr.update()
+    return [listener, endpoint]
+
+
+async def grade_attempt(audio: str, language: str, session_id: str):
+    """shows the scores of a long passage part by part while it is being graded"""
+    async with session_store.use_async(session_id) as session:
+        async for result_json in grade_pronunciation(
+            audio, session.conversation, language, session_id
+        ):
+            yield result_json
 
 
-def kick_start(
-    topic: str, language: str, history: gr.Chatbot
-) -> list[gr.Chatbot, gr.update]:
-    history = [
-        [
-            FIRST_USER_MESSAGE[language][topic],
-            None,
+async def user(audio: str, language: str, session_id: str, student: str) -> gr.Chatbot:
+    async with session_store.use_async(session_id) as session:
+        conversation = session.conversation
+        # grade_attempt already assessed this recording, so this is a cache hit
+        grading = await grade(audio, conversation, language, session_id=session_id)
+        score = "Pronunciation score:\n" + grading.score_lines()
+        student = student_id(student, session_id)
+        store = await asyncio.to_thread(word_store)
+        await asyncio.to_thread(store.add, student, language, grading.words)
+        targets = await asyncio.to_thread(store.summary, student, language)
+        conversation.add_scores(score, targets)
+        player = play_audio(audio, session_id=session_id)
+        session.history.append([score + "\n\n" + player, None])
+        return session.history
+
+
+async def stream_reply(
+    conversation: PronunciationConversation,
+    temperature: float,
+    language: str,
+    session_id: str | None,
+):
+    """streams a reply and starts the example audio at its closing backtick"""
+    conversation.reference_text = None
+    conversation.example = None
+    detector = ExampleDetector()
+    async for delta in timed_stream(
+        staged_stream(
+            "llm",
+            stream_chat(
+                conversation.messages(),
+                temperature=temperature,
+                timeout=GENERATION_TIMEOUT,
+            ),
+        ),
+        session_id=session_id,
+        language=language,
+        backend=CHAT_BACKEND,
+    ):
+        reference_text = detector.feed(delta)
+        if reference_text:
+            start_example(conversation, reference_text, language, session_id)
+        yield delta
+
+
+async def kick_start(topic: str, language: str, session_id: str, student: str = ""):
+    async with session_store.use_async(session_id) as session:
+        history = session.history = [
+            [
+                FIRST_USER_MESSAGE[language][topic],
+                None,
+            ]
         ]
-    ]
-    messages = compose_pronunciation_messages(history, topic, language)
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", messages=messages, temperature=0.8
-    )
-    history[-1][1] = response["choices"][0]["message"]["content"]
-    return [history, gr.update(interactive=True)]
+        conversation = session.conversation = PronunciationConversation(
+            INITIAL_PROMPT[language][topic], language
+        )
+        # a returning student starts with the words they are still working on
+        store = await asyncio.to_thread(word_store)
+        conversation.summary = await asyncio.to_thread(
+            store.summary, student_id(student, session_id), language
+        )
+        conversation.add_user(FIRST_USER_MESSAGE[language][topic])
 
+        history[-1][1] = ""
+        async for delta in stream_reply(conversation, 0.8, language, session_id):
+            history[-1][1] += delta
+            yield [history, gr.update()]
+        conversation.add_assistant(history[-1][1])
+        yield [history, gr.update(interactive=True)]
 
-def bot(history: gr.Chatbot, topic: str, language: str) -> gr.Chatbot:
-    messages = compose_pronunciation_messages(history, topic, language)
 
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", messages=messages, temperature=0.5
-    )
-    history[-1][1] = ""
-    for word in response["choices"][0]["message"]["content"].split():
-        history[-1][1] += word + " "
-        time.sleep(0.1)
-        yield history
-    # start = time.time()
-    # elapsed_time = 0.0
-    # response = openai.ChatCompletion.create(
-    #     model="gpt-3.5-turbo", messages=messages, temperature=0.5, stream=True
-    # )
+async def bot(topic: str, language: str, session_id: str):
+    async with session_store.use_async(session_id) as session:
+        history, conversation = session.history, session.conversation
+        conversation.system = INITIAL_PROMPT[language][topic]
+
+        history[-1][1] = ""
+        async for delta in stream_reply(conversation, 0.5, language, session_id):
+            history[-1][1] += delta
+            yield history
+        conversation.add_assistant(history[-1][1])
+
+
+async def play_next_example(language: str, session_id: str) -> gr.Chatbot:
+    async with session_store.use_async(session_id) as session:
+        return await play_example(
+            session.history, session.conversation, language, session_id
+        )
+
 
-    # history[-1][1] = ""
-    # for chunk in response:
-    #     history[-1][1] += chunk.choices[0].delta.get("content", "")
-    #     if not chunk.choices[0].delta.get("finish_reason", ""):
-    #         elapsed_time = time.time() - start
-    #         print(f"{elapsed_time=}")
-    #     elif chunk.choices[0].delta.get("finish_reason", "") == "stop":
-    #         print('Break due to "finish_reason": "stop"')
-    #         break
-    #     else:
-    #         print(
-    #             f'unknown stop reason: {chunk.choices[0].delta.get("finish_reason", "")}'
-    #         )
-    #     if elapsed_time >= 30:
-    #         break
-    #     yield history
+def clear_conversation(session_id: str) -> list:
+    media_store.spool.release_session(session_id)
+    session_store.clear(session_id)
+    return [[], gr.update(interactive=False)]
 
 
 with gr.Blocks() as demo:
@@ -187,48 +245,103 @@ with gr.Blocks() as demo:
             choices=["Business", "Hobby", "Daily life"],
             value="Business",
         )
+        student = gr.Textbox(label="Student", placeholder="Name to keep progress")
         start = gr.Button("Start practice")
         clear = gr.Button("Clear conversation", size="sm")
+    status = gr.Markdown()
     chatbot = gr.Chatbot()
+    # the only state the browser holds, everything else is in the session store
+    session_id = gr.Textbox(visible=False)
+    # the streaming listener, the trimmed recording it leaves behind, and a
+    # hidden component that changes when the student stops speaking
+    listener = gr.State(None)
+    recording = gr.State(None)
+    endpoint = gr.Textbox(visible=False)
     with gr.Row():
-        audio = gr.Audio(source="microphone", type="filepath", format="wav")
+        audio = gr.Audio(
+            source="microphone", type="numpy", streaming=True, elem_id="microphone"
+        )
         # text = gr.Textbox(label="Recognized input", interactive=True)
         btn_text = gr.Button("Submit text", interactive=False)
         reset_recording = gr.Button("Clear recording")
     assessment = gr.Textbox(label="Pronunciation assessment result", interactive=False)
 
-    start.click(kick_start, [topic, lang, chatbot], [chatbot, btn_text]).success(
-        play_example, [chatbot, lang], chatbot, queue=True
-    )
+    start.click(
+        kick_start,
+        [topic, lang, session_id, student],
+        [chatbot, btn_text],
+    ).success(play_next_example, [lang, session_id], chatbot, queue=True)
 
     # audio.change(
     #     speech_recognize_continuous_from_file,
-    #     [audio, chatbot, lang],
+    #     [audio, lang],
     #     [text],
     #     queue=True,
     # )
-    btn_text.click(
-        grade_pronunciation, [audio, chatbot, lang], assessment, queue=True
-    ).success(user, [audio, chatbot, lang], chatbot, queue=True).success(
-        bot, [chatbot, topic, lang], chatbot, queue=True
-    ).success(
-        play_example, [chatbot, lang], chatbot, queue=True
-    ).success(
-        lambda: None, None, audio, queue=False
+    audio.start_recording(start_listening, listener, listener, queue=False)
+    audio.stream(
+        record_attempt,
+        [audio, lang, listener, session_id],
+        [listener, endpoint],
+        show_progress=False,
     )
+    audio.stop_recording(
+        finish_recording, [listener, session_id], [recording, listener], queue=True
+    )
+
+    def submit_attempt(then):
+        then(
+            grade_attempt,
+            [recording, lang, session_id],
+            assessment,
+            queue=True,
+        ).success(
+            user,
+            [recording, lang, session_id, student],
+            chatbot,
+            queue=True,
+        ).success(
+            bot, [topic, lang, session_id], chatbot, queue=True
+        ).success(
+            play_next_example, [lang, session_id], chatbot, queue=True
+        ).success(
+            lambda: [None, None], None, [audio, recording], queue=False
+        )
+
+    # the end of speech stops the microphone and submits the attempt
+    submit_attempt(
+        endpoint.change(
+            finish_recording,
+            [listener, session_id],
+            [recording, listener],
+            queue=True,
+            _js=STOP_MIC_JS,
+        ).success
+    )
+    submit_attempt(btn_text.click)
 
     reset_recording.click(
-        lambda: None,
+        lambda: [None, None],
         None,
-        audio,
+        [audio, recording],
         queue=False,
-    )
+    ).then(drop_recording, listener, listener, queue=False)
     clear.click(
-        lambda: None,
-        None,
-        chatbot,
+        clear_conversation,
+        session_id,
+        [chatbot, btn_text],
         queue=False,
     )
+    demo.load(
+        resume_session,
+        session_id,
+        [session_id, chatbot, btn_text],
+        queue=False,
+        _js=restore_session_js("talk-pronunciation"),
+    ).then(None, session_id, None, _js=remember_session_js("talk-pronunciation"))
+    demo.load(backpressure, None, status, every=STATUS_INTERVAL)
 
-demo.queue()
-demo.launch(debug=True)
+if __name__ == "__main__":
+    warm_up()
+    demo.queue(concurrency_count=QUEUE_CONCURRENCY)
+    demo.launch(debug=True, allowed_paths=media_store.allowed_paths)
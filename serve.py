@@ -0,0 +1,83 @@
+"""serves the conversation and pronunciation apps from one process.
+
+    python serve.py                       # both apps
+    python serve.py --mode pronunciation  # only one of them
+
+The conversation app is mounted at `/` and the pronunciation app at
+`/pronunciation`; they share the speech connections, caches and stage
+limits of the process. Only the apps of the chosen mode are imported.
+The server starts while the backends warm up in the background, and
+`/ready` answers 503 until they are warm, with the error if warming up
+failed. Startup time and memory are printed, logged as metrics and
+included in the `/ready` response.
+"""
+
+import time
+
+_started = time.perf_counter()
+
+import argparse
+import importlib
+
+import gradio as gr
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+
+from utils.media import media_store
+from utils.metrics import observe, rss_mb
+from utils.speech import readiness, warm_up
+from utils.stages import QUEUE_CONCURRENCY
+
+# mode -> (module defining `demo`, path it is mounted at)
+APPS = {
+    "conversation": ("app", "/"),
+    "pronunciation": ("pronunciation", "/pronunciation"),
+}
+MODES = {
+    "conversation": ["conversation"],
+    "pronunciation": ["pronunciation"],
+    "both": ["conversation", "pronunciation"],
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", default="both", choices=list(MODES))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7860)
+    args = parser.parse_args()
+
+    startup: dict[str, dict[str, float]] = {}
+
+    def report(phase: str) -> None:
+        seconds = time.perf_counter() - _started
+        rss = rss_mb()
+        startup[phase] = {"seconds": round(seconds, 2), "rss_mb": round(rss, 1)}
+        print(f"Startup ({args.mode}): {phase} after {seconds:.2f} s, RSS {rss:.0f} MB")
+        observe(f"startup_{phase}", seconds, mode=args.mode, rss_mb=round(rss, 1))
+
+    server = FastAPI()
+
+    @server.get("/ready")
+    def ready() -> JSONResponse:
+        status = {"mode": args.mode, "startup": startup, **readiness()}
+        return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+    # mounted longest path first, since "/" would also match the others
+    names = sorted(MODES[args.mode], key=lambda name: -len(APPS[name][1]))
+    for name in names:
+        module, path = APPS[name]
+        demo: gr.Blocks = importlib.import_module(module).demo
+        demo.queue(concurrency_count=QUEUE_CONCURRENCY)
+        # `launch` would set this, mounting bypasses it
+        demo.allowed_paths = media_store.allowed_paths
+        server = gr.mount_gradio_app(server, demo, path=path)
+    report("ui")
+
+    warm_up(background=True, on_ready=lambda: report("ready"))
+    uvicorn.run(server, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
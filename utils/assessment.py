@@ -0,0 +1,242 @@
+import asyncio
+import difflib
+import hashlib
+import json
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+
+
+@dataclass
+class PhonemeScore:
+    phoneme: str
+    accuracy: float
+
+
+@dataclass
+class WordScore:
+    word: str
+    accuracy: float
+    error_type: str = "None"
+    phonemes: list[PhonemeScore] = field(default_factory=list)
+
+
+@dataclass
+class AssessmentResult:
+    """the parts of a pronunciation assessment that the apps display and prompt with"""
+
+    reference_text: str
+    recognized_text: str
+    accuracy: float
+    fluency: float
+    completeness: float
+    pronunciation: float
+    words: list[WordScore]
+    json: str
+
+    @classmethod
+    def from_json(cls, reference_text: str, result_json: str | None):
+        if not result_json:
+            raise ValueError("The speech service returned no assessment result")
+        best = json.loads(result_json)["NBest"][0]
+        scores = best.get("PronunciationAssessment", {})
+        words = [
+            WordScore(
+                word=elm["Word"],
+                accuracy=elm["PronunciationAssessment"].get("AccuracyScore", 0.0),
+                error_type=elm["PronunciationAssessment"].get("ErrorType", "None"),
+                phonemes=[
+                    PhonemeScore(
+                        phoneme=p["Phoneme"],
+                        accuracy=p["PronunciationAssessment"]["AccuracyScore"],
+                    )
+                    for p in elm.get("Phonemes", [])
+                ],
+            )
+            for elm in best.get("Words", [])
+        ]
+        return cls(
+            reference_text=reference_text,
+            recognized_text=best.get("Display", ""),
+            accuracy=scores.get("AccuracyScore", 0.0),
+            fluency=scores.get("FluencyScore", 0.0),
+            completeness=scores.get("CompletenessScore", 0.0),
+            pronunciation=scores.get("PronScore", 0.0),
+            words=words,
+            json=result_json,
+        )
+
+    def score_lines(self) -> str:
+        return "\n".join(f"{w.word}: {w.accuracy}" for w in self.words)
+
+
+# languages written without spaces, aligned character by character
+UNSEGMENTED_LANGUAGES = ("ja", "zh", "th")
+
+
+def _units(text: str, spaced: bool) -> list[str]:
+    """what the alignment compares: words, or characters without spaces"""
+    text = text.lower()
+    if not spaced:
+        return [c for c in text if c.isalnum()]
+    words = ("".join(c for c in w if c.isalnum() or c == "'") for w in text.split())
+    return [w for w in words if w]
+
+
+def merge_segments(
+    reference_text: str, segments: list[str], language: str, final: bool = True
+) -> str:
+    """combines the JSON results of the consecutive segments of one recording.
+
+    Continuous recognition marks no omissions or insertions, so the words
+    of all segments are aligned against the reference text with difflib:
+    reference words nobody said are added as omissions and recognized words
+    that are not in the reference are marked as insertions. Accuracy is the
+    mean over the words that were read, completeness the share of the
+    reference that was, and fluency that of the segments weighted by their
+    number of words. The overall score combines the three like the speech
+    SDK's continuous assessment sample does, so omissions lower it too.
+    Unless `final`, the end of the reference is not read yet rather than
+    omitted.
+    """
+    spaced = not language.startswith(UNSEGMENTED_LANGUAGES)
+    bests = [json.loads(segment)["NBest"][0] for segment in segments]
+
+    def score(elm: dict, name: str, default=0.0):
+        return elm.get("PronunciationAssessment", {}).get(name, default)
+
+    recognized = [
+        word
+        for best in bests
+        for word in best.get("Words", [])
+        if score(word, "ErrorType", "None") != "Omission"
+    ]
+    reference = _units(reference_text, spaced)
+    # every unit of the recognized words, with the word it belongs to
+    units, owners = [], []
+    for i, word in enumerate(recognized):
+        for unit in _units(word["Word"], spaced):
+            units.append(unit)
+            owners.append(i)
+
+    matcher = difflib.SequenceMatcher(None, reference, units, autojunk=False)
+    opcodes = matcher.get_opcodes()
+    if not final and opcodes and opcodes[-1][0] == "delete":
+        opcodes.pop()
+    matched = {
+        owners[j]
+        for tag, _, _, j1, j2 in opcodes
+        if tag == "equal"
+        for j in range(j1, j2)
+    }
+
+    words, emitted = [], set()
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag in ("delete", "replace"):
+            omitted = reference[i1:i2] if spaced else ["".join(reference[i1:i2])]
+            words += [
+                {
+                    "Word": unit,
+                    "PronunciationAssessment": {
+                        "AccuracyScore": 0.0,
+                        "ErrorType": "Omission",
+                    },
+                }
+                for unit in omitted
+            ]
+        for i in dict.fromkeys(owners[j1:j2]):
+            if i in emitted:
+                continue
+            emitted.add(i)
+            word = recognized[i]
+            if i not in matched:
+                word = {
+                    **word,
+                    "PronunciationAssessment": {
+                        **word.get("PronunciationAssessment", {}),
+                        "ErrorType": "Insertion",
+                    },
+                }
+            words.append(word)
+    # words without any unit to align, such as a lone punctuation mark
+    words += [w for i, w in enumerate(recognized) if i not in emitted]
+
+    read = [w for w in words if score(w, "ErrorType", "None") == "None"]
+    matched_units = sum(i2 - i1 for tag, i1, i2, _, _ in opcodes if tag == "equal")
+
+    def weighted(name: str) -> float:
+        counts = [len(best.get("Words", [])) for best in bests]
+        total = sum(score(best, name) * n for best, n in zip(bests, counts))
+        return total / sum(counts) if sum(counts) else 0.0
+
+    def ratio(part: float, whole: int) -> float:
+        return part / whole if whole else 0.0
+
+    accuracy = ratio(sum(score(w, "AccuracyScore") for w in read), len(read))
+    fluency = weighted("FluencyScore")
+    completeness = 100 * ratio(matched_units, len(reference))
+    # the lowest two scores weigh 0.4 each, the highest 0.2
+    lowest, middle, highest = sorted([accuracy, fluency, completeness])
+    return json.dumps(
+        {
+            "NBest": [
+                {
+                    "Display": " ".join(best.get("Display", "") for best in bests),
+                    "PronunciationAssessment": {
+                        "AccuracyScore": accuracy,
+                        "FluencyScore": fluency,
+                        "CompletenessScore": completeness,
+                        "PronScore": 0.4 * lowest + 0.4 * middle + 0.2 * highest,
+                    },
+                    "Words": words,
+                }
+            ]
+        },
+        ensure_ascii=False,
+    )
+
+
+def audio_digest(audio: str) -> str:
+    with open(audio, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class AssessmentCache:
+    """remembers recent assessments so each recording is sent to the service once.
+
+    Keys are (audio content hash, reference text, language, granularity).
+    Concurrent requests for the same key share one in-flight assessment.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._results: OrderedDict[tuple, asyncio.Future] = OrderedDict()
+
+    async def get(
+        self, key: tuple, assess: Callable[[], Awaitable[AssessmentResult]]
+    ) -> AssessmentResult:
+        if key in self._results:
+            self._results.move_to_end(key)
+            return await asyncio.shield(self._results[key])
+
+        future = asyncio.get_running_loop().create_future()
+        self._results[key] = future
+        while len(self._results) > self.max_entries:
+            self._results.popitem(last=False)
+        try:
+            result = await assess()
+        except BaseException as e:
+            # failures are not remembered, the next submission tries again
+            self._results.pop(key, None)
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                # mark the exception as retrieved when nobody else is waiting
+                future.exception()
+            raise
+        future.set_result(result)
+        return result
+
+
+assessment_cache = AssessmentCache()
@@ -0,0 +1,211 @@
+import asyncio
+import functools
+import io
+import math
+import os
+import struct
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+from dotenv import load_dotenv
+
+from utils.vad import trim, vad_settings
+
+load_dotenv()
+
+# what the speech services work with internally
+TARGET_SAMPLE_RATE = 16000
+# speech level the recordings are normalized to, in dBFS
+TARGET_LEVEL_DB = float(os.environ.get("TARGET_LEVEL_DB", -23))
+MAX_GAIN_DB = 20.0
+AUDIO_WORKERS = int(os.environ.get("AUDIO_WORKERS", min(os.cpu_count() or 1, 4)))
+
+_pool = ThreadPoolExecutor(max_workers=AUDIO_WORKERS, thread_name_prefix="audio")
+
+
+@dataclass
+class PcmAudio:
+    """16-bit mono PCM held in memory, ready to be streamed to a backend"""
+
+    data: bytes
+    sample_rate: int = TARGET_SAMPLE_RATE
+
+    @property
+    def samples(self) -> np.ndarray:
+        return np.frombuffer(self.data, dtype="<i2")
+
+
+def wav_bytes(pcm: bytes, sample_rate: int, channels: int = 1) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(channels)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(pcm)
+    return buffer.getvalue()
+
+
+def read_wav(path: str) -> tuple[np.ndarray, int]:
+    """reads integer or float WAV as float32 samples of shape (frames, channels)"""
+    with open(path, "rb") as f:
+        data = f.read()
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        raise ValueError(f"{path} is not a WAV file")
+    fmt = None
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id, size = struct.unpack("<4sI", data[pos : pos + 8])
+        body = data[pos + 8 : pos + 8 + size]
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack("<HHIIHH", body[:16])
+            if fmt[0] == 0xFFFE:
+                # WAVE_FORMAT_EXTENSIBLE keeps the real format in the sub format
+                fmt = (struct.unpack("<H", body[24:26])[0],) + fmt[1:]
+        elif chunk_id == b"data" and fmt is not None:
+            audio_format, channels, sample_rate, _, _, bits = fmt
+            if audio_format == 3:
+                samples = np.frombuffer(body, dtype=f"<f{bits // 8}")
+            elif bits == 8:
+                samples = (np.frombuffer(body, dtype=np.uint8) - 128.0) / 128
+            elif bits == 24:
+                raw = np.frombuffer(body, dtype=np.uint8).astype(np.int32)
+                raw = raw[: len(raw) // 3 * 3].reshape(-1, 3)
+                ints = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+                samples = np.where(ints >= 2**23, ints - 2**24, ints) / float(2**23)
+            else:
+                samples = np.frombuffer(body, dtype=f"<i{bits // 8}")
+                samples = samples / float(2 ** (bits - 1))
+            samples = samples[: len(samples) // channels * channels]
+            return samples.astype(np.float32).reshape(-1, channels), sample_rate
+        # chunks are padded to an even size
+        pos += 8 + size + (size & 1)
+    raise ValueError(f"{path} has no audio data")
+
+
+def downmix(samples: np.ndarray) -> np.ndarray:
+    return samples.mean(axis=1) if samples.ndim > 1 else samples
+
+
+@functools.cache
+def _resample_poly():
+    """scipy's resampler, imported on first use since scipy is slow to import"""
+    try:
+        from scipy.signal import resample_poly
+    except ImportError:
+        return None
+    return resample_poly
+
+
+def _lowpass(sample_rate: int, target: int) -> np.ndarray:
+    """a windowed sinc that removes what `target` cannot represent"""
+    cutoff = 0.5 * target / sample_rate
+    taps = np.arange(-32, 33)
+    kernel = 2 * cutoff * np.sinc(2 * cutoff * taps) * np.hanning(len(taps))
+    return kernel / kernel.sum()
+
+
+def resample(samples: np.ndarray, sample_rate: int, target: int) -> np.ndarray:
+    if sample_rate == target:
+        return samples
+    divisor = math.gcd(sample_rate, target)
+    up, down = target // divisor, sample_rate // divisor
+    resample_poly = _resample_poly()
+    if resample_poly is not None:
+        return resample_poly(samples, up, down).astype(np.float32)
+    # without scipy: low-pass with a windowed sinc, then interpolate
+    if target < sample_rate:
+        samples = np.convolve(samples, _lowpass(sample_rate, target), mode="same")
+    positions = np.arange(int(len(samples) * target / sample_rate)) * (
+        sample_rate / target
+    )
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.float32)
+
+
+class Resampler:
+    """resamples a stream chunk by chunk as if it were one recording.
+
+    The low-pass filter continues from the end of the previous chunk and the
+    output positions carry over, so the chunk boundaries leave no jumps and
+    no samples are dropped.
+    """
+
+    def __init__(self, sample_rate: int, target: int = TARGET_SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.target = target
+        self._kernel = _lowpass(sample_rate, target) if target < sample_rate else None
+        # the filter's input history, zeros before the stream starts
+        self._history = np.zeros(0 if self._kernel is None else len(self._kernel) - 1)
+        # filtered samples the next outputs still interpolate from
+        self._filtered = np.zeros(0)
+        # index in the filtered stream of `_filtered[0]`
+        self._offset = 0
+        self._emitted = 0
+
+    def feed(self, samples: np.ndarray) -> np.ndarray:
+        """the float mono output for the next chunk of float mono input"""
+        if self.sample_rate == self.target:
+            return samples.astype(np.float32)
+        if self._kernel is not None:
+            window = np.concatenate([self._history, samples])
+            self._history = window[len(window) - len(self._history) :]
+            samples = np.convolve(window, self._kernel, mode="valid")
+        self._filtered = np.concatenate([self._filtered, samples])
+        # the filter delays its output by half its length
+        delay = 0 if self._kernel is None else len(self._kernel) // 2
+        last = self._offset + len(self._filtered) - 1
+        # output n sits at input position n * sample_rate / target
+        available = (last - delay) * self.target // self.sample_rate + 1
+        n = np.arange(self._emitted, max(available, self._emitted))
+        if not len(n):
+            return np.zeros(0, dtype=np.float32)
+        positions = n * self.sample_rate / self.target + delay - self._offset
+        output = np.interp(positions, np.arange(len(self._filtered)), self._filtered)
+        self._emitted += len(n)
+        # keep what the next output interpolates from
+        start = min(self._emitted * self.sample_rate // self.target + delay, last + 1)
+        self._filtered = self._filtered[start - self._offset :]
+        self._offset = start
+        return output.astype(np.float32)
+
+
+def normalize_loudness(samples: np.ndarray, frame: int = 320) -> np.ndarray:
+    """brings the speech, ignoring the quiet frames, to TARGET_LEVEL_DB"""
+    n_frames = len(samples) // frame
+    if n_frames == 0:
+        return samples
+    frames = samples[: n_frames * frame].reshape(n_frames, frame)
+    levels = np.sqrt(np.mean(frames**2, axis=1))
+    # the loudest half of the frames stands for the speech
+    speech = levels[levels >= np.median(levels)]
+    level_db = 20 * np.log10(max(float(np.sqrt(np.mean(speech**2))), 1e-10))
+    gain_db = min(TARGET_LEVEL_DB - level_db, MAX_GAIN_DB)
+    samples = samples * 10 ** (gain_db / 20)
+    # never clip: back off to the peak if the gain would push past full scale
+    peak = float(np.max(np.abs(samples)))
+    return samples / peak * 0.99 if peak > 0.99 else samples
+
+
+def to_pcm16(samples: np.ndarray) -> bytes:
+    return (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+
+def conform(samples: np.ndarray, sample_rate: int) -> np.ndarray:
+    """float mono at TARGET_SAMPLE_RATE, from any channel count and rate"""
+    return resample(downmix(samples), sample_rate, TARGET_SAMPLE_RATE)
+
+
+def load(path: str, language: str | None = None) -> PcmAudio:
+    """reads and normalizes a recording, trimming silence when `language` is given"""
+    samples, sample_rate = read_wav(path)
+    mono = conform(samples, sample_rate)
+    if language is not None:
+        mono = trim(mono, TARGET_SAMPLE_RATE, vad_settings(language))
+    return PcmAudio(to_pcm16(normalize_loudness(mono)))
+
+
+async def prepare(path: str, language: str | None = None) -> PcmAudio:
+    """`load` in the audio worker pool, off the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_pool, load, path, language)
@@ -1,13 +1,16 @@
-import base64
-import os
-import re
-import time
-import uuid
+import asyncio
+import threading
+from typing import AsyncIterator
 
 import azure.cognitiveservices.speech as speechsdk
-import gradio as gr
 from dotenv import load_dotenv
 
+from utils.audio import PcmAudio
+from utils.resilience import POLICIES, BackendError
+from utils.speech_backends import SpeechBackend
+from utils.speech_pool import OUTPUT_FORMATS, SPEECH_OUTPUT_FORMAT, speech_pool
+from utils.stages import stages
+
 load_dotenv()
 
 
@@ -18,35 +21,84 @@ SPEECH_DICT = {
     "ja-JP": "ja-JP-NanamiNeural",
 }
 
+# file suffix of the audio the synthesizers produce
+SPEECH_OUTPUT_SUFFIX = OUTPUT_FORMATS[SPEECH_OUTPUT_FORMAT][1]
+
+# cancellations that may succeed when the request is sent again
+RETRYABLE_ERRORS = {
+    speechsdk.CancellationErrorCode.ConnectionFailure,
+    speechsdk.CancellationErrorCode.ServiceTimeout,
+    speechsdk.CancellationErrorCode.ServiceError,
+    speechsdk.CancellationErrorCode.ServiceUnavailable,
+    speechsdk.CancellationErrorCode.TooManyRequests,
+}
+
+
+def _resolver(future: asyncio.Future):
+    """returns a callback that SDK threads can use to resolve `future` on its own loop"""
+    loop = future.get_loop()
+
+    def resolve(value):
+        loop.call_soon_threadsafe(lambda: future.done() or future.set_result(value))
+
+    return resolve
+
+
+def _cancellation_error(cancellation_details) -> BackendError:
+    message = f"Azure Speech canceled the request: {cancellation_details.reason}"
+    if cancellation_details.error_details:
+        message += f" ({cancellation_details.error_details})"
+    retryable = cancellation_details.error_code in RETRYABLE_ERRORS
+    return BackendError(message, retryable=retryable)
+
+
+def _check(cancellation_details) -> None:
+    """raises for a cancellation caused by an error, not the end of the audio"""
+    if (
+        cancellation_details is not None
+        and cancellation_details.reason == speechsdk.CancellationReason.Error
+    ):
+        raise _cancellation_error(cancellation_details)
+
+
+def _audio_config(audio: str | PcmAudio) -> speechsdk.audio.AudioConfig:
+    """reads a file, or streams in-memory PCM without writing it anywhere"""
+    if not isinstance(audio, PcmAudio):
+        return speechsdk.audio.AudioConfig(filename=audio)
+    stream = speechsdk.audio.PushAudioInputStream(
+        stream_format=speechsdk.audio.AudioStreamFormat(
+            samples_per_second=audio.sample_rate, bits_per_sample=16, channels=1
+        )
+    )
+    stream.write(audio.data)
+    stream.close()
+    return speechsdk.audio.AudioConfig(stream=stream)
+
 
-def speech_recognize_continuous_from_file(
-    audio: str, history: list[list[str]], language: str
-) -> str:
+async def recognize(audio: str | PcmAudio, language: str) -> str:
     """performs continuous speech recognition with input from an audio file"""
     # <SpeechContinuousRecognitionWithFile>
-    speech_config = speechsdk.SpeechConfig(
-        subscription=os.environ.get("SPEECH_KEY"),
-        region=os.environ.get("SPEECH_REGION"),
-    )
-    audio_config = speechsdk.audio.AudioConfig(filename=audio)
+    speech_config = speech_pool.speech_config(language)
+    audio_config = _audio_config(audio)
 
     speech_recognizer = speechsdk.SpeechRecognizer(
         speech_config=speech_config, audio_config=audio_config, language=language
     )
 
-    done = False
+    done = asyncio.get_running_loop().create_future()
+    stop_cb = _resolver(done)
     recognized_text = ""
+    cancellation_details = None
 
     def recognized(evt):
         print(f"RECOGNIZED: {evt}")
         nonlocal recognized_text
         recognized_text += evt.result.text
 
-    def stop_cb(evt):
-        """callback that signals to stop continuous recognition upon receiving an event `evt`"""
-        print("CLOSING on {}".format(evt))
-        nonlocal done
-        done = True
+    def canceled(evt):
+        print("CANCELED {}".format(evt))
+        nonlocal cancellation_details
+        cancellation_details = evt.cancellation_details
 
     # Connect callbacks to the events fired by the speech recognizer
     # speech_recognizer.recognizing.connect(lambda evt: print('RECOGNIZING: {}'.format(evt)))
@@ -57,125 +109,261 @@ def speech_recognize_continuous_from_file(
     speech_recognizer.session_stopped.connect(
         lambda evt: print("SESSION STOPPED {}".format(evt))
     )
-    speech_recognizer.canceled.connect(lambda evt: print("CANCELED {}".format(evt)))
+    speech_recognizer.canceled.connect(canceled)
     # stop continuous recognition on either session stopped or canceled events
     speech_recognizer.session_stopped.connect(stop_cb)
     speech_recognizer.canceled.connect(stop_cb)
 
     # Start continuous speech recognition
-    speech_recognizer.start_continuous_recognition()
-    while not done:
-        time.sleep(0.5)
-
-    speech_recognizer.stop_continuous_recognition()
-
+    speech_recognizer.start_continuous_recognition_async()
+    try:
+        await done
+    finally:
+        # the session is already over, so this returns as soon as the SDK confirms
+        await stages["asr"].run(speech_recognizer.stop_continuous_recognition)
+
+    _check(cancellation_details)
     return recognized_text
 
 
-def play_audio(file_path: str):
-    print(file_path)
-    with open(file_path, "rb") as f:
-        audio_bytes = f.read()
+async def synthesize(text: str, lang: str) -> speechsdk.SpeechSynthesisResult:
+    """synthesizes `text` with a pooled synthesizer, keeping the audio in memory.
 
-    audio = base64.b64encode(audio_bytes).decode("utf-8")
-    audio_player = (
-        f'<audio src="data:audio/mpeg;base64,{audio}" controls autoplay></audio>'
+    The audio is encoded in SPEECH_OUTPUT_FORMAT and available as
+    `result.audio_data`.
+    """
+    voice = SPEECH_DICT[lang]
+    # checking out may open a new connection, which must not block the event loop
+    speech_synthesizer = await speech_pool.acquire_async(
+        lang, voice, stages["tts"].executor
     )
-
-    return audio_player
-
-
-def to_sppech(audio: str, history: gr.Chatbot, lang: str) -> gr.Chatbot:
-    output_path = audio.replace(".wav", "output.wav")
-    speech_config = speechsdk.SpeechConfig(
-        subscription=os.environ.get("SPEECH_KEY"),
-        region=os.environ.get("SPEECH_REGION"),
+    done = asyncio.get_running_loop().create_future()
+    resolve = _resolver(done)
+    speech_synthesizer.synthesis_completed.connect(lambda evt: resolve(evt.result))
+    speech_synthesizer.synthesis_canceled.connect(lambda evt: resolve(evt.result))
+
+    finished = False
+    try:
+        speech_synthesizer.speak_text_async(text)
+        speech_synthesis_result = await done
+        finished = True
+    finally:
+        speech_synthesizer.synthesis_completed.disconnect_all()
+        speech_synthesizer.synthesis_canceled.disconnect_all()
+        speech_pool.release(lang, voice, speech_synthesizer, discard=not finished)
+
+    return speech_synthesis_result
+
+
+def _assessment_recognizer(
+    audio: str | PcmAudio, reference_text: str, language: str, granularity: str
+) -> speechsdk.SpeechRecognizer:
+    speech_config = speech_pool.speech_config(language)
+    audio_config = _audio_config(audio)
+    speech_recognizer = speechsdk.SpeechRecognizer(
+        speech_config=speech_config, audio_config=audio_config, language=language
     )
-    audio_config = speechsdk.audio.AudioOutputConfig(filename=output_path)
-    speech_config.speech_synthesis_voice_name = SPEECH_DICT[lang]
 
-    speech_synthesizer = speechsdk.SpeechSynthesizer(
-        speech_config=speech_config, audio_config=audio_config
+    pronunciation_assessment_config = speechsdk.PronunciationAssessmentConfig(
+        reference_text=reference_text,
+        grading_system=speechsdk.PronunciationAssessmentGradingSystem.HundredMark,
+        granularity=getattr(speechsdk.PronunciationAssessmentGranularity, granularity),
+        enable_miscue=True,
     )
-
-    text = history[-1][1]
-    speech_synthesis_result = speech_synthesizer.speak_text_async(text).get()
-
-    if (
-        speech_synthesis_result.reason
-        == speechsdk.ResultReason.SynthesizingAudioCompleted
-    ):
-        print("Speech synthesized for text [{}]".format(text))
-        history[-1][1] += "\n\n" + play_audio(output_path)
-        return history
-    elif speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
-        cancellation_details = speech_synthesis_result.cancellation_details
-        print("Speech synthesis canceled: {}".format(cancellation_details.reason))
-        if cancellation_details.reason == speechsdk.CancellationReason.Error:
-            if cancellation_details.error_details:
-                print("Error details: {}".format(cancellation_details.error_details))
-                print("Did you set the speech resource key and region values?")
-
-
-def play_example(history: gr.Chatbot, lang: str) -> gr.Chatbot:
-    dir = f"/tmp/gradio/{uuid.uuid4()}"
-    os.mkdir(dir)
-    output_path = os.path.join(dir, "example.wav")
-    speech_config = speechsdk.SpeechConfig(
-        subscription=os.environ.get("SPEECH_KEY"),
-        region=os.environ.get("SPEECH_REGION"),
+    pronunciation_assessment_config.apply_to(speech_recognizer)
+    return speech_recognizer
+
+
+async def assess_segments(
+    audio: str | PcmAudio,
+    reference_text: str,
+    language: str,
+    granularity: str = "Phoneme",
+) -> AsyncIterator[str]:
+    """grades `audio` with continuous recognition, yielding the JSON result of each
+    utterance as it is recognized, so passages longer than one utterance are
+    assessed to the end"""
+    speech_recognizer = _assessment_recognizer(
+        audio, reference_text, language, granularity
     )
-    audio_config = speechsdk.audio.AudioOutputConfig(filename=output_path)
-    speech_config.speech_synthesis_voice_name = SPEECH_DICT[lang]
+    loop = asyncio.get_running_loop()
+    # JSON results of the segments, then None once the session is over
+    segments: asyncio.Queue[str | None] = asyncio.Queue()
+    cancellation_details = None
 
-    speech_synthesizer = speechsdk.SpeechSynthesizer(
-        speech_config=speech_config, audio_config=audio_config
-    )
-    m = re.findall(r"\`+(.+?)\`+", history[-1][1])
-    reference_text = m[0]
+    def put(segment: str | None) -> None:
+        loop.call_soon_threadsafe(segments.put_nowait, segment)
+
+    def recognized(evt):
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech:
+            put(
+                evt.result.properties.get(
+                    speechsdk.PropertyId.SpeechServiceResponse_JsonResult
+                )
+            )
 
-    speech_synthesis_result = speech_synthesizer.speak_text_async(reference_text).get()
+    def canceled(evt):
+        nonlocal cancellation_details
+        cancellation_details = evt.cancellation_details
 
+    speech_recognizer.recognized.connect(recognized)
+    speech_recognizer.canceled.connect(canceled)
+    speech_recognizer.session_stopped.connect(lambda evt: put(None))
+    speech_recognizer.canceled.connect(lambda evt: put(None))
+
+    speech_recognizer.start_continuous_recognition_async()
+    # a segment takes about as long as a whole short recording, so the deadline
+    # of an assessment applies to each of them
+    deadline = POLICIES["assessment"].deadline
+    try:
+        while True:
+            try:
+                segment = await asyncio.wait_for(segments.get(), deadline)
+            except asyncio.TimeoutError:
+                raise BackendError("Azure Speech did not finish the assessment in time")
+            if segment is None:
+                break
+            yield segment
+    finally:
+        await stages["assessment"].run(speech_recognizer.stop_continuous_recognition)
+    _check(cancellation_details)
+
+
+class StreamingRecognizer:
+    """continuous recognition fed with microphone chunks while the student is talking.
+
+    `text` holds the recognized utterances followed by the current partial
+    hypothesis, so the transcript is ready as soon as the recording stops.
+    """
+
+    def __init__(self, language: str, sample_rate: int, channels: int = 1):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.stream = speechsdk.audio.PushAudioInputStream(
+            stream_format=speechsdk.audio.AudioStreamFormat(
+                samples_per_second=sample_rate, bits_per_sample=16, channels=channels
+            )
+        )
+        self.speech_recognizer = speechsdk.SpeechRecognizer(
+            speech_config=speech_pool.speech_config(language),
+            audio_config=speechsdk.audio.AudioConfig(stream=self.stream),
+            language=language,
+        )
+        self.closed = False
+        self.cancellation_details = None
+        self._recognized = ""
+        self._partial = ""
+        self._lock = threading.Lock()
+        self._done = asyncio.get_running_loop().create_future()
+        stop_cb = _resolver(self._done)
+
+        self.speech_recognizer.recognizing.connect(self._on_recognizing)
+        self.speech_recognizer.recognized.connect(self._on_recognized)
+        self.speech_recognizer.canceled.connect(self._on_canceled)
+        self.speech_recognizer.session_stopped.connect(stop_cb)
+        self.speech_recognizer.canceled.connect(stop_cb)
+        self.speech_recognizer.start_continuous_recognition_async()
+
+    def _on_recognizing(self, evt) -> None:
+        with self._lock:
+            self._partial = evt.result.text
+
+    def _on_recognized(self, evt) -> None:
+        print(f"RECOGNIZED: {evt}")
+        with self._lock:
+            self._recognized += evt.result.text
+            self._partial = ""
+
+    def _on_canceled(self, evt) -> None:
+        print("CANCELED {}".format(evt))
+        self.cancellation_details = evt.cancellation_details
+
+    @property
+    def text(self) -> str:
+        with self._lock:
+            return self._recognized + self._partial
+
+    def write(self, pcm: bytes) -> None:
+        # a chunk can arrive after the recording has already been stopped
+        if self.closed:
+            return
+        self.stream.write(pcm)
+
+    async def finish(self) -> str:
+        """ends the audio stream and waits for the last utterance"""
+        self.closed = True
+        self.stream.close()
+        try:
+            # only the tail is left, but a stalled session must not hang the turn
+            await asyncio.wait_for(self._done, POLICIES["asr"].deadline)
+        except asyncio.TimeoutError:
+            raise BackendError("Azure Speech did not finish the recognition in time")
+        finally:
+            await stages["asr"].run(self.speech_recognizer.stop_continuous_recognition)
+        _check(self.cancellation_details)
+        return self.text
+
+    async def close(self) -> None:
+        """ends the session without waiting for a transcript nobody will read"""
+        self.closed = True
+        self.stream.close()
+        await stages["asr"].run(self.speech_recognizer.stop_continuous_recognition)
+
+
+def report_synthesis(
+    speech_synthesis_result: speechsdk.SpeechSynthesisResult, text: str
+) -> bool:
+    """logs the outcome of a synthesis and returns whether it produced audio"""
     if (
         speech_synthesis_result.reason
         == speechsdk.ResultReason.SynthesizingAudioCompleted
     ):
-        print("Speech synthesized for text [{}]".format(reference_text))
-        history[-1][1] += "\n\n" + play_audio(output_path)
-        return history
+        print("Speech synthesized for text [{}]".format(text))
+        return True
     elif speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
         cancellation_details = speech_synthesis_result.cancellation_details
         print("Speech synthesis canceled: {}".format(cancellation_details.reason))
         if cancellation_details.reason == speechsdk.CancellationReason.Error:
             if cancellation_details.error_details:
                 print("Error details: {}".format(cancellation_details.error_details))
-                print("Did you set the speech resource key and region values?")
-
-
-def grade_pronunciation(audio: str, history: gr.Chatbot, language: str) -> str:
-    speech_config = speechsdk.SpeechConfig(
-        subscription=os.environ.get("SPEECH_KEY"),
-        region=os.environ.get("SPEECH_REGION"),
-    )
-    audio_config = speechsdk.audio.AudioConfig(filename=audio)
-    speech_recognizer = speechsdk.SpeechRecognizer(
-        speech_config=speech_config, audio_config=audio_config, language=language
-    )
-
-    m = re.findall(r"\`+(.+?)\`+", history[-1][1])
-    reference_text = m[0]
-    pronunciation_assessment_config = speechsdk.PronunciationAssessmentConfig(
-        reference_text=reference_text,
-        grading_system=speechsdk.PronunciationAssessmentGradingSystem.HundredMark,
-        granularity=speechsdk.PronunciationAssessmentGranularity.Phoneme,
-        enable_miscue=True,
-    )
-    pronunciation_assessment_config.apply_to(speech_recognizer)
-
-    speech_recognition_result = speech_recognizer.recognize_once()
-
-    # The pronunciation assessment result as a JSON string
-    pronunciation_assessment_result_json = speech_recognition_result.properties.get(
-        speechsdk.PropertyId.SpeechServiceResponse_JsonResult
-    )
-    return pronunciation_assessment_result_json
+    return False
+
+
+class AzureBackend(SpeechBackend):
+    """Azure Speech, through the pooled synthesizers and the functions above"""
+
+    name = "azure"
+    output_format = SPEECH_OUTPUT_FORMAT
+    suffix = SPEECH_OUTPUT_SUFFIX
+
+    def voice(self, language: str) -> str:
+        return SPEECH_DICT[language]
+
+    async def recognize(self, audio: str | PcmAudio, language: str) -> str:
+        return await recognize(audio, language)
+
+    async def synthesize(self, text: str, language: str) -> bytes | None:
+        speech_synthesis_result = await synthesize(text, language)
+        if report_synthesis(speech_synthesis_result, text):
+            return speech_synthesis_result.audio_data
+        if speech_synthesis_result.reason == speechsdk.ResultReason.Canceled:
+            cancellation_details = speech_synthesis_result.cancellation_details
+            raise _cancellation_error(cancellation_details)
+
+    async def assess_segments(
+        self,
+        audio: str | PcmAudio,
+        reference_text: str,
+        language: str,
+        granularity: str,
+    ) -> AsyncIterator[str]:
+        async for segment in assess_segments(
+            audio, reference_text, language, granularity
+        ):
+            yield segment
+
+    def streaming_recognizer(self, language: str, sample_rate: int, channels: int):
+        return StreamingRecognizer(language, sample_rate, channels)
+
+    def warm_up(self, languages: list[str]) -> None:
+        speech_pool.warm_up({language: SPEECH_DICT[language] for language in languages})
@@ -0,0 +1,177 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+from utils.openai import summarize
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+load_dotenv()
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", 1500))
+CONTEXT_RECENT_TURNS = int(os.environ.get("CONTEXT_RECENT_TURNS", 6))
+
+# rough characters per token when tiktoken is not installed
+CHARS_PER_TOKEN = {
+    "en-US": 4.0,
+    "en-GB": 4.0,
+    "sv-SE": 3.0,
+    "ja-JP": 1.0,
+}
+
+# what an earlier score block is replaced with once a newer one arrives
+SCORES_RECORDED = "(Pronunciation scores recorded in the practice targets)"
+
+_summarizer = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summarizer")
+
+
+def count_tokens(text: str, language: str) -> int:
+    if tiktoken is not None:
+        return len(tiktoken.get_encoding("cl100k_base").encode(text))
+    return int(len(text) / CHARS_PER_TOKEN.get(language, 4.0)) + 1
+
+
+class Conversation:
+    """the clean text turns of one session, kept apart from the chatbot rendering.
+
+    Turns are appended as they happen, so building the prompt never has to
+    walk the rendered history or strip audio tags back out of it. The prompt
+    holds the last `recent_turns` turns verbatim, trimmed to `token_budget`;
+    older turns are folded into a running summary in the background.
+    """
+
+    fold_in_background = True
+    summary_title = "Summary of the earlier conversation"
+
+    def __init__(
+        self,
+        system: str,
+        language: str = "en-US",
+        recent_turns: int = CONTEXT_RECENT_TURNS,
+        token_budget: int = CONTEXT_TOKEN_BUDGET,
+    ):
+        self.system = system
+        self.language = language
+        self.recent_turns = recent_turns
+        self.token_budget = token_budget
+        self.turns: list[dict[str, str]] = []
+        self.summary = ""
+        self._tokens: list[int] = []
+        # turns before this index are represented by the summary
+        self._folded = 0
+        self._folding: Future | None = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # a fold still running is simply done again after the session is resumed
+        state = self.__dict__.copy()
+        del state["_lock"]
+        state["_folding"] = None
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _append(self, role: str, content: str) -> None:
+        self.turns.append({"role": role, "content": content})
+        self._tokens.append(count_tokens(content, self.language))
+        self._maybe_fold()
+
+    def add_user(self, content: str) -> None:
+        self._append("user", content)
+
+    def add_assistant(self, content: str) -> None:
+        self._append("assistant", content)
+
+    def _maybe_fold(self) -> None:
+        end = len(self.turns) - self.recent_turns
+        if end <= self._folded:
+            return
+        if not self.fold_in_background:
+            self._fold(end)
+        elif self._folding is None or self._folding.done():
+            self._folding = _summarizer.submit(self._fold, end)
+
+    def _fold(self, end: int) -> None:
+        try:
+            summary = self.summarize(self._folded, end)
+        except Exception as e:
+            print(f"Could not summarize the conversation: {e}")
+            return
+        with self._lock:
+            self.summary = summary
+            self._folded = end
+
+    def summarize(self, start: int, end: int) -> str:
+        return summarize(self.turns[start:end], self.summary)
+
+    def messages(self) -> list[dict[str, str]]:
+        with self._lock:
+            summary, folded = self.summary, self._folded
+
+        messages = [{"role": "system", "content": self.system}]
+        budget = self.token_budget - count_tokens(self.system, self.language)
+        if summary:
+            messages.append(
+                {
+                    "role": "system",
+                    "content": f"{self.summary_title}:\n{summary}",
+                }
+            )
+            budget -= count_tokens(summary, self.language)
+
+        # newest turns first, always keeping the latest one
+        start = len(self.turns)
+        while start > folded:
+            budget -= self._tokens[start - 1]
+            if budget < 0 and start < len(self.turns):
+                break
+            start -= 1
+        return messages + self.turns[start:]
+
+
+class PronunciationConversation(Conversation):
+    """a pronunciation practice session, prompted with targets instead of old scores.
+
+    Only the latest score block is sent verbatim. Earlier ones are replaced
+    by a marker, and the summary holds the targets the word store worked
+    out from every attempt, which survives the folding of old turns.
+    """
+
+    fold_in_background = False
+    summary_title = "Current practice targets"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the turn holding the latest score block, the only one sent verbatim
+        self._scored: int | None = None
+        # the example of the latest reply and the synthesis of its audio
+        self.reference_text: str | None = None
+        self.example: asyncio.Task | None = None
+
+    def __getstate__(self) -> dict:
+        state = super().__getstate__()
+        # the example can still be graded, only the task making its audio is dropped
+        state["example"] = None
+        return state
+
+    def add_scores(self, content: str, targets: str = "") -> None:
+        # only the previous block is still verbatim, the older ones are markers
+        if self._scored is not None:
+            self.turns[self._scored]["content"] = SCORES_RECORDED
+            self._tokens[self._scored] = count_tokens(SCORES_RECORDED, self.language)
+        with self._lock:
+            self.summary = targets
+        self._scored = len(self.turns)
+        self._append("user", content)
+
+    def summarize(self, start: int, end: int) -> str:
+        # the targets already cover every attempt, folding just drops the turns
+        return self.summary
@@ -0,0 +1,25 @@
+import random
+from typing import Callable
+
+# distribution name -> sampler taking the parameters of the spec
+DISTRIBUTIONS: dict[str, Callable[..., float]] = {
+    "const": lambda seconds: seconds,
+    "uniform": random.uniform,
+    "normal": random.gauss,
+    # median and sigma of the underlying normal, the long tail real services have
+    "lognormal": lambda median, sigma: median * random.lognormvariate(0, sigma),
+    "exp": lambda mean: random.expovariate(1 / mean) if mean else 0.0,
+}
+
+
+def latency_sampler(spec: str) -> Callable[[], float]:
+    """parses "0.2", "uniform:0.1,0.5", "normal:0.3,0.05", "lognormal:0.3,0.6"
+    or "exp:0.3" into a function returning a latency in seconds"""
+    name, _, params = spec.strip().partition(":")
+    if not params:
+        name, params = "const", name or "0"
+    if name not in DISTRIBUTIONS:
+        raise ValueError(f"Unknown latency distribution: {spec}")
+    args = [float(p) for p in params.split(",")]
+    sample = DISTRIBUTIONS[name]
+    return lambda: max(sample(*args), 0.0)
@@ -0,0 +1,89 @@
+import mimetypes
+import os
+import shutil
+import uuid
+
+from dotenv import load_dotenv
+
+from utils.spool import AudioSpool
+from utils.tts_cache import TTS_CACHE_DIR
+
+load_dotenv()
+
+MEDIA_ROOT = os.environ.get("MEDIA_ROOT", "/tmp/gradio/media")
+
+MIME_TYPES = {
+    ".wav": "audio/wav",
+    ".mp3": "audio/mpeg",
+    ".ogg": "audio/ogg",
+    ".opus": "audio/ogg",
+    ".webm": "audio/webm",
+}
+
+
+class MediaStore:
+    """keeps audio as files served by Gradio's `/file=` route.
+
+    The chat history only holds a short `<audio>` tag pointing at the file,
+    and the route answers HTTP range requests, so players can seek and
+    stream without the browser ever receiving the audio inline. Every file
+    the store writes or links in is handed to its spool for cleanup.
+    """
+
+    def __init__(self, root: str = MEDIA_ROOT, extra_dirs: list[str] | None = None):
+        self.root = os.path.abspath(root)
+        self.dirs = [self.root] + [os.path.abspath(d) for d in extra_dirs or []]
+        self.spool = AudioSpool(keep_dirs=self.dirs)
+        os.makedirs(self.root, exist_ok=True)
+
+    @property
+    def allowed_paths(self) -> list[str]:
+        """the directories to pass to `launch(allowed_paths=...)`"""
+        return self.dirs
+
+    def new_path(self, suffix: str) -> str:
+        return os.path.join(self.root, f"{uuid.uuid4().hex}{suffix}")
+
+    def put(self, data: bytes, suffix: str, session_id: str | None = None) -> str:
+        """writes in-memory audio to a new file in the store"""
+        path = self.new_path(suffix)
+        with open(path, "wb") as f:
+            f.write(data)
+        return self.spool.track(path, session_id)
+
+    def add(self, path: str, session_id: str | None = None) -> str:
+        """makes `path` servable, linking it into the store when it lives elsewhere"""
+        path = os.path.abspath(path)
+        if any(os.path.commonpath([path, d]) == d for d in self.dirs):
+            return path
+        stored = self.new_path(os.path.splitext(path)[1])
+        try:
+            os.link(path, stored)
+        except OSError:
+            shutil.copyfile(path, stored)
+        # the original, e.g. a Gradio recording, is ours to clean up as well
+        self.spool.track(path, session_id)
+        return self.spool.track(stored, session_id)
+
+    def url(self, path: str, session_id: str | None = None) -> str:
+        # relative, so it also resolves when the app is mounted under a sub path
+        return f"file={self.add(path, session_id)}"
+
+    @staticmethod
+    def mime_type(path: str) -> str:
+        suffix = os.path.splitext(path)[1].lower()
+        return MIME_TYPES.get(suffix) or mimetypes.guess_type(path)[0] or "audio/wav"
+
+    def player(
+        self, path: str, autoplay: bool = True, session_id: str | None = None
+    ) -> str:
+        autoplay_attr = " autoplay" if autoplay else ""
+        src = self.url(path, session_id)
+        return (
+            f"<audio controls{autoplay_attr}>"
+            f'<source src="{src}" type="{self.mime_type(path)}">'
+            "</audio>"
+        )
+
+
+media_store = MediaStore(extra_dirs=[TTS_CACHE_DIR])
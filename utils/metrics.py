@@ -0,0 +1,196 @@
+import json
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import AsyncIterator, Callable
+
+from dotenv import load_dotenv
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+load_dotenv()
+
+# port of the Prometheus scrape endpoint, 0 turns it off
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 9464))
+# address the scrape endpoint listens on, only this machine by default
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+# file the JSON event log is appended to, empty turns it off; it holds session
+# ids, so it must stay out of the directories Gradio serves at /file=
+METRICS_LOG = os.environ.get(
+    "METRICS_LOG", os.path.expanduser("~/.local/state/talk/metrics.jsonl")
+)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0)
+
+if prometheus_client is not None:
+    # sessions are only in the event log, as a label they would grow without bound
+    STAGE_SECONDS = prometheus_client.Histogram(
+        "talk_stage_seconds",
+        "Time spent in each stage of a turn",
+        ["stage", "language", "backend"],
+        buckets=LATENCY_BUCKETS,
+    )
+    SPEECH_TO_AUDIO_SECONDS = prometheus_client.Histogram(
+        "talk_speech_to_audio_seconds",
+        "Time from the student stopping speaking to the first teacher audio",
+        ["language"],
+        buckets=LATENCY_BUCKETS,
+    )
+
+
+class EventLog:
+    """appends one JSON object per line, written by a background thread"""
+
+    def __init__(self, path: str = METRICS_LOG):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def _run(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                f.write(self._queue.get())
+                # write whatever else is waiting before flushing once
+                while not self._queue.empty():
+                    f.write(self._queue.get())
+                f.flush()
+
+    def write(self, event: dict) -> None:
+        if not self.path:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(
+                    target=self._run, name="metrics-log", daemon=True
+                )
+                self._writer.start()
+        self._queue.put(json.dumps(event, ensure_ascii=False) + "\n")
+
+
+event_log = EventLog()
+
+# session -> when the student last stopped speaking
+_speech_ends: dict[str, float] = {}
+_started = False
+# called with every event, e.g. by a load test collecting the latencies
+_subscribers: list[Callable[[dict], None]] = []
+
+
+def subscribe(callback: Callable[[dict], None]) -> None:
+    _subscribers.append(callback)
+
+
+def _emit(event: dict) -> None:
+    event_log.write(event)
+    for callback in _subscribers:
+        callback(event)
+
+
+def start(port: int = METRICS_PORT, host: str = METRICS_HOST) -> None:
+    """serves the Prometheus metrics, once per process"""
+    global _started
+    if _started or not port:
+        return
+    _started = True
+    if prometheus_client is None:
+        print("Install prometheus-client to export metrics, logging events only")
+        return
+    prometheus_client.start_http_server(port, addr=host)
+    print(f"Metrics on http://{host}:{port}/metrics")
+
+
+def observe(
+    stage: str,
+    seconds: float,
+    session_id: str | None = None,
+    language: str | None = None,
+    backend: str | None = None,
+    **fields,
+) -> None:
+    if prometheus_client is not None:
+        STAGE_SECONDS.labels(stage, language or "", backend or "").observe(seconds)
+    _emit(
+        {
+            "time": time.time(),
+            "stage": stage,
+            "seconds": round(seconds, 4),
+            "session": session_id,
+            "language": language,
+            "backend": backend,
+            **fields,
+        }
+    )
+
+
+@contextmanager
+def span(stage: str, **tags):
+    """times the block as `stage`, marking it failed when it raises"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        observe(stage, time.perf_counter() - start, error=type(e).__name__, **tags)
+        raise
+    observe(stage, time.perf_counter() - start, **tags)
+
+
+async def timed_stream(
+    deltas: AsyncIterator[str], stage: str = "llm", **tags
+) -> AsyncIterator[str]:
+    """passes a token stream through, recording time to first token and in total"""
+    start = time.perf_counter()
+    first = True
+    async for delta in deltas:
+        if first:
+            observe(f"{stage}_ttft", time.perf_counter() - start, **tags)
+            first = False
+        yield delta
+    observe(f"{stage}_total", time.perf_counter() - start, **tags)
+
+
+def speech_ended(session_id: str | None, at: float | None = None) -> None:
+    """marks the moment (a perf_counter value) the student stopped speaking"""
+    if session_id is not None:
+        _speech_ends[session_id] = at if at is not None else time.perf_counter()
+
+
+def first_audio(session_id: str | None, language: str) -> None:
+    """records the end-to-end latency when the first teacher audio of a turn is ready"""
+    ended = _speech_ends.pop(session_id, None)
+    if ended is None:
+        return
+    seconds = time.perf_counter() - ended
+    if prometheus_client is not None:
+        SPEECH_TO_AUDIO_SECONDS.labels(language).observe(seconds)
+    _emit(
+        {
+            "time": time.time(),
+            "stage": "speech_to_audio",
+            "seconds": round(seconds, 4),
+            "session": session_id,
+            "language": language,
+        }
+    )
+
+
+def rss_mb() -> float:
+    """the memory the process currently holds, in MB"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # the peak instead, where there is no /proc; macOS reports it in bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
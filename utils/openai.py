@@ -1,12 +1,32 @@
+import asyncio
+import functools
 import os
-import re
+import random
+from typing import AsyncIterator
 
-import gradio as gr
-import openai
 from dotenv import load_dotenv
 
+from utils.latency import latency_sampler
+from utils.resilience import BackendError, guard
+
 load_dotenv()
-openai.api_key = os.environ.get("OPENAI_API_KEY")
+
+# seconds without a new chunk after which a streamed reply is given up on
+STREAM_STALL_TIMEOUT = float(os.environ.get("STREAM_STALL_TIMEOUT", 10))
+# seconds a summary may take, it runs in the background
+SUMMARY_TIMEOUT = 60
+
+# "fake" answers with a canned reply instead of calling the API, for load tests
+CHAT_BACKEND = os.environ.get("CHAT_BACKEND", "openai")
+# time to the first token and between tokens of the fake, see utils.latency
+FAKE_CHAT_LATENCY = os.environ.get("FAKE_CHAT_LATENCY", "0")
+FAKE_TOKEN_LATENCY = os.environ.get("FAKE_TOKEN_LATENCY", "0")
+# the example differs every time, so it is synthesized and graded every time
+FAKE_REPLY = (
+    "That sounds great, well done. "
+    "Let's keep going with the next sentence. "
+    "Please read this one aloud: `I would like {cups} cups of coffee, please.`"
+)
 
 
 SYSTEM_DESCRIPTION_EN = """You are an experienced English teacher.
@@ -38,38 +58,132 @@ SYSTEM_DESCRIPTION_DICT = {
 }
 
 
-def compose_messages(history: gr.Chatbot, language: str) -> list[dict[str, str]]:
-    messages = [{"role": "system", "content": SYSTEM_DESCRIPTION_DICT[language]}]
-
-    for t in history:
-        for i, elm in enumerate(t):
-            match i:
-                case i if i % 2 == 0:
-                    messages += [
-                        {
-                            "role": "user",
-                            "content": re.sub(r"\<audio.*\/audio\>", "", elm),
-                        }
-                    ]
-                case i if i % 2 == 1 and elm:
-                    messages += [
-                        {
-                            "role": "assistant",
-                            "content": re.sub(r"\<audio.*\/audio\>", "", elm),
-                        }
-                    ]
-    return messages
-
-
-def bot(history: gr.Chatbot, language: str) -> gr.Chatbot:
-    messages = compose_messages(history, language)
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo", messages=messages, temperature=0.8, stream=True
+@functools.cache
+def _openai():
+    """the openai module, imported on the first request to keep startup fast"""
+    import openai
+
+    openai.api_key = os.environ.get("OPENAI_API_KEY")
+    return openai
+
+
+def _retryable(e: Exception) -> bool:
+    """whether an API error may go away when the request is sent again"""
+    openai = _openai()
+    return isinstance(
+        e,
+        (
+            openai.error.APIConnectionError,
+            openai.error.APIError,
+            openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError,
+            openai.error.Timeout,
+        ),
     )
 
-    history[-1][1] = ""
-    for chunk in response:
-        chunk_message = chunk["choices"][0]["delta"]
-        if "content" in chunk_message:
-            history[-1][1] += chunk_message["content"]
-            yield history
+
+async def _fake_chunks() -> AsyncIterator[dict]:
+    """FAKE_REPLY word by word, as the chunks of a streamed ChatCompletion"""
+    first = latency_sampler(FAKE_CHAT_LATENCY)
+    between = latency_sampler(FAKE_TOKEN_LATENCY)
+    await asyncio.sleep(first())
+    reply = FAKE_REPLY.format(cups=random.randint(2, 999999))
+    for i, word in enumerate(reply.split(" ")):
+        if i:
+            await asyncio.sleep(between())
+        yield {"choices": [{"delta": {"content": word + " "}, "finish_reason": None}]}
+
+
+async def _open_stream(
+    messages: list[dict[str, str]], temperature: float, model: str
+) -> tuple[AsyncIterator, dict | None]:
+    """starts a streamed ChatCompletion and waits for its first chunk"""
+    if CHAT_BACKEND == "fake":
+        chunks = _fake_chunks().__aiter__()
+        return chunks, await chunks.__anext__()
+    openai = _openai()
+    try:
+        response = await openai.ChatCompletion.acreate(
+            model=model, messages=messages, temperature=temperature, stream=True
+        )
+        chunks = response.__aiter__()
+        try:
+            return chunks, await chunks.__anext__()
+        except StopAsyncIteration:
+            return chunks, None
+    except openai.error.OpenAIError as e:
+        raise BackendError(str(e), retryable=_retryable(e)) from e
+
+
+async def stream_chat(
+    messages: list[dict[str, str]],
+    temperature: float,
+    model: str = "gpt-3.5-turbo",
+    timeout: float | None = None,
+) -> AsyncIterator[str]:
+    """yields the content deltas of a streamed ChatCompletion as they arrive.
+
+    Until the first chunk arrives the request is retried, hedged and given
+    a deadline by the "llm" guard. With a `timeout`, the reply is cut off
+    once that many seconds have passed since the request, or when no chunk
+    has arrived for STREAM_STALL_TIMEOUT seconds, keeping whatever has been
+    streamed so far.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+
+    def next_chunk() -> float:
+        if deadline is None:
+            return STREAM_STALL_TIMEOUT
+        return min(max(deadline - loop.time(), 0), STREAM_STALL_TIMEOUT)
+
+    llm = guard(CHAT_BACKEND, "llm")
+    first_chunk = llm.policy.deadline
+    if deadline is not None:
+        first_chunk = min(first_chunk, max(deadline - loop.time(), 0))
+    chunks, chunk = await llm.call(
+        lambda: _open_stream(messages, temperature, model), first_chunk
+    )
+    try:
+        while chunk is not None:
+            chunk_message = chunk["choices"][0]["delta"]
+            if "content" in chunk_message:
+                yield chunk_message["content"]
+            finish_reason = chunk["choices"][0].get("finish_reason")
+            if finish_reason not in (None, "stop"):
+                print(f"unknown stop reason: {finish_reason}")
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), next_chunk())
+            except StopAsyncIteration:
+                chunk = None
+    except asyncio.TimeoutError:
+        print(f"Break due to the {timeout} s generation limit or a stalled stream")
+
+
+SUMMARY_PROMPT = """Summarize the earlier part of this conversation between a language teacher and a student in a few sentences.
+Keep what the teacher needs to continue: the student's level, topics covered and recurring mistakes.
+Write the summary in the language of the conversation.
+"""
+
+
+def summarize(
+    turns: list[dict[str, str]],
+    previous_summary: str = "",
+    model: str = "gpt-3.5-turbo",
+) -> str:
+    """folds `turns` into the running summary of a conversation"""
+    transcript = "\n".join(f'{t["role"]}: {t["content"]}' for t in turns)
+    if previous_summary:
+        transcript = f"Summary so far:\n{previous_summary}\n\n{transcript}"
+    if CHAT_BACKEND == "fake":
+        return transcript[:200]
+    response = _openai().ChatCompletion.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ],
+        temperature=0.0,
+        request_timeout=SUMMARY_TIMEOUT,
+    )
+    return response["choices"][0]["message"]["content"]
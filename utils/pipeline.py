@@ -0,0 +1,113 @@
+import asyncio
+import re
+from typing import AsyncIterator, Awaitable, Callable
+
+# a sentence ends at western punctuation followed by whitespace (or by CJK
+# text, which has no spaces), at CJK punctuation, or at a line break
+_SENTENCE_END = re.compile(
+    r"[.!?]+[\"')\]]*(?:\s+|(?=[^\x00-\x7f]))|[。！？]+[」』）]*\s*|\n+"
+)
+
+# the example sentence of a pronunciation reply, quoted in backticks
+_EXAMPLE = re.compile(r"`+([^`\n]+?)`")
+
+
+class SentenceSplitter:
+    """cuts a stream of text deltas into complete sentences"""
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text: str) -> list[str]:
+        self.buffer += text
+        sentences = []
+        start = 0
+        for m in _SENTENCE_END.finditer(self.buffer):
+            sentence = self.buffer[start : m.end()].strip()
+            if sentence:
+                sentences.append(sentence)
+            start = m.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self) -> list[str]:
+        sentence = self.buffer.strip()
+        self.buffer = ""
+        return [sentence] if sentence else []
+
+
+class ExampleDetector:
+    """finds the first backtick-quoted example in a stream of text deltas.
+
+    The example is returned by the `feed` call that delivers its closing
+    backtick, while the rest of the reply is still streaming.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.example: str | None = None
+
+    def feed(self, text: str) -> str | None:
+        if self.example is not None:
+            return None
+        self.buffer += text
+        m = _EXAMPLE.search(self.buffer)
+        if m:
+            self.example = m.group(1)
+            self.buffer = ""
+            return self.example
+
+
+async def speak_while_streaming(
+    deltas: AsyncIterator[str], speak: Callable[[str], Awaitable]
+) -> AsyncIterator[tuple[str | None, object]]:
+    """yields (delta, None) for every text delta of `deltas` and (None, audio) for
+    every sentence spoken by `speak`.
+
+    Each sentence is handed to `speak` as soon as it is complete, so synthesis
+    runs while the rest of the reply is still streaming. Audio is yielded in
+    sentence order, however the syntheses finish.
+    """
+    events: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def deliver(synthesis: asyncio.Task, previous: asyncio.Task | None):
+        audio = await synthesis
+        if previous is not None:
+            await previous
+        events.put_nowait((None, audio))
+
+    async def produce():
+        splitter = SentenceSplitter()
+        previous = None
+        tasks = []
+
+        def schedule(sentences: list[str]):
+            nonlocal previous
+            for sentence in sentences:
+                synthesis = asyncio.create_task(speak(sentence))
+                previous = asyncio.create_task(deliver(synthesis, previous))
+                tasks.extend([synthesis, previous])
+
+        try:
+            async for delta in deltas:
+                events.put_nowait((delta, None))
+                schedule(splitter.feed(delta))
+            schedule(splitter.flush())
+            if previous is not None:
+                await previous
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            events.put_nowait(done)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (event := await events.get()) is not done:
+            yield event
+        # re-raises whatever stopped the producer
+        await producer
+    finally:
+        producer.cancel()
@@ -0,0 +1,220 @@
+import asyncio
+import json
+import os
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, replace
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+T = TypeVar("T")
+
+
+@dataclass
+class Policy:
+    # seconds a call may take in total, retries and hedges included
+    deadline: float = 30.0
+    # attempts after the first, only for errors worth retrying
+    retries: int = 2
+    # first backoff in seconds, doubled for every retry, with full jitter
+    backoff: float = 0.2
+    max_backoff: float = 2.0
+    # a duplicate is sent once an attempt is slower than this quantile of the
+    # recent latencies, 0 turns hedging off
+    hedge_quantile: float = 0.95
+    # latencies needed before the quantile is trusted
+    hedge_min_samples: int = 20
+    # failed calls in a row that open the circuit
+    failure_threshold: int = 5
+    # seconds the circuit stays open before a trial call is let through
+    cooldown: float = 30.0
+
+
+POLICIES = {
+    "asr": Policy(deadline=20.0),
+    "tts": Policy(deadline=15.0),
+    "assessment": Policy(deadline=20.0),
+    # covers the time to the first token; the rest of the reply has its own limit
+    "llm": Policy(deadline=15.0, retries=1),
+}
+
+# e.g. RESILIENCE_OVERRIDES='{"tts": {"deadline": 10}, "llm": {"hedge_quantile": 0}}'
+for _task, _fields in json.loads(os.environ.get("RESILIENCE_OVERRIDES", "{}")).items():
+    POLICIES[_task] = replace(POLICIES.get(_task, Policy()), **_fields)
+
+
+class BackendError(Exception):
+    """a speech or language model call that failed, and whether to try it again"""
+
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class DeadlineExceeded(BackendError):
+    pass
+
+
+class CircuitOpen(BackendError):
+    pass
+
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, BackendError):
+        return e.retryable
+    return isinstance(e, (asyncio.TimeoutError, ConnectionError))
+
+
+class Guard:
+    """deadline, retries, hedging and a circuit breaker for calls to one backend.
+
+    Each call gets `policy.deadline` seconds in total. Errors marked as
+    retryable are retried after a jittered backoff while there is time left.
+    An attempt slower than the usual latencies gets a duplicate, and
+    whichever finishes first wins. After `failure_threshold` failed calls in
+    a row, calls fail at once until the cooldown has passed.
+    """
+
+    def __init__(self, name: str, policy: Policy):
+        self.name = name
+        self.policy = policy
+        self.latencies: deque[float] = deque(maxlen=200)
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+
+    def hedge_delay(self) -> float | None:
+        """seconds to wait for an attempt before sending a duplicate"""
+        quantile = self.policy.hedge_quantile
+        if not quantile or len(self.latencies) < self.policy.hedge_min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * quantile), len(latencies) - 1)]
+
+    def _check_circuit(self) -> None:
+        if self.opened_at is None:
+            return
+        wait = self.opened_at + self.policy.cooldown - time.monotonic()
+        if wait > 0 or self._probing:
+            raise CircuitOpen(
+                f"{self.name} is unavailable, trying again in {max(wait, 1):.0f} s"
+            )
+        # half open: a single call finds out whether the backend is back
+        self._probing = True
+
+    def _record(self, ok: bool) -> None:
+        self._probing = False
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+            return
+        self.failures += 1
+        if self.failures >= self.policy.failure_threshold:
+            if self.opened_at is None:
+                print(f"{self.name} failed {self.failures} times, opening the circuit")
+            self.opened_at = time.monotonic()
+
+    async def _hedged(self, call: Callable[[], Awaitable[T]]) -> T:
+        delay = self.hedge_delay()
+        start = time.perf_counter()
+        tasks = [asyncio.ensure_future(call())]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                print(f"{self.name} is slower than usual ({delay:.2f} s), hedging")
+                tasks.append(asyncio.ensure_future(call()))
+            while True:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self.latencies.append(time.perf_counter() - start)
+                        return task.result()
+                pending = [task for task in tasks if not task.done()]
+                if not pending:
+                    raise done.pop().exception()
+                tasks = pending
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def call(
+        self, call: Callable[[], Awaitable[T]], deadline: float | None = None
+    ) -> T:
+        """awaits `call()`, a fresh attempt every time it is called"""
+        self._check_circuit()
+        loop = asyncio.get_running_loop()
+        seconds = self.policy.deadline if deadline is None else deadline
+        until = loop.time() + seconds
+        attempt = 0
+        while True:
+            try:
+                result = await asyncio.wait_for(
+                    self._hedged(call), max(until - loop.time(), 0)
+                )
+            except asyncio.CancelledError:
+                self._probing = False
+                raise
+            except Exception as e:
+                # an attempt can time out on its own before the deadline
+                if isinstance(e, asyncio.TimeoutError) and loop.time() >= until - 0.01:
+                    self._record(False)
+                    message = f"{self.name} took longer than {seconds:g} s"
+                    raise DeadlineExceeded(message) from None
+                delay = random.uniform(
+                    0, min(self.policy.max_backoff, self.policy.backoff * 2**attempt)
+                )
+                if (
+                    not _retryable(e)
+                    or attempt >= self.policy.retries
+                    or loop.time() + delay >= until
+                ):
+                    self._record(False)
+                    raise
+                attempt += 1
+                print(f"{self.name} failed ({e}), retry {attempt} in {delay:.2f} s")
+                await asyncio.sleep(delay)
+                continue
+            self._record(True)
+            return result
+
+    async def stream(self, items: AsyncIterator[T]) -> AsyncIterator[T]:
+        """passes `items` through, failing fast while the circuit is open.
+
+        What was already passed on cannot be taken back, so a stream is not
+        retried or hedged; how it ended still counts towards the circuit.
+        """
+        self._check_circuit()
+        try:
+            async for item in items:
+                yield item
+        except Exception:
+            self._record(False)
+            raise
+        except BaseException:
+            # cancelled or closed by the consumer, which says nothing about us
+            self._probing = False
+            raise
+        self._record(True)
+
+
+_guards: dict[str, Guard] = {}
+
+
+def guard(backend: str, task: str, hedge: bool = True) -> Guard:
+    """the guard of `task` ("asr", "tts", "assessment" or "llm") on `backend`"""
+    name = f"{backend}.{task}"
+    if name not in _guards:
+        policy = POLICIES.get(task, Policy())
+        if not hedge:
+            policy = replace(policy, hedge_quantile=0.0)
+        _guards[name] = Guard(name, policy)
+    return _guards[name]
+
+
+def open_circuits() -> list[str]:
+    """the guards that are currently failing fast"""
+    return [name for name, g in _guards.items() if g.opened_at is not None]
@@ -0,0 +1,288 @@
+import asyncio
+import os
+import pickle
+import re
+import sys
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# outside /tmp/gradio, which Gradio serves at /file=
+SESSION_DIR = os.environ.get(
+    "SESSION_DIR", os.path.expanduser("~/.cache/talk/sessions")
+)
+# memory all sessions together may take before idle ones are spilled to disk
+SESSION_MEMORY_MB = float(os.environ.get("SESSION_MEMORY_MB", 256))
+# sessions used more recently than this stay in memory whatever the budget
+SESSION_IDLE_SECONDS = float(os.environ.get("SESSION_IDLE_SECONDS", 60))
+# spilled sessions not resumed for this long are deleted
+SESSION_TTL_HOURS = float(os.environ.get("SESSION_TTL_HOURS", 24 * 7))
+SESSION_PRUNE_INTERVAL = float(os.environ.get("SESSION_PRUNE_INTERVAL", 600))
+
+# ids come back from the browser, so only ours are accepted
+_SESSION_ID = re.compile(r"[0-9a-f]{32}")
+
+
+def new_session() -> str:
+    return uuid.uuid4().hex
+
+
+def restore_session_js(key: str) -> str:
+    """passes the id this browser last used with the app in place of the input"""
+    return f"(session_id) => [localStorage.getItem({key!r}) || session_id]"
+
+
+def remember_session_js(key: str) -> str:
+    return (
+        f"(session_id) => {{ localStorage.setItem({key!r}, session_id); return []; }}"
+    )
+
+
+class Session:
+    """what the server keeps for one student: the chat as shown and the conversation"""
+
+    def __init__(self, session_id: str):
+        self.id = session_id
+        # [user, assistant] pairs as rendered by the chatbot
+        self.history: list[list[str | None]] = []
+        self.conversation = None
+        self.last_used = time.monotonic()
+        self.size = 0
+        self.users = 0
+
+    def __getstate__(self) -> dict:
+        # a resumed session is accounted for from scratch
+        state = self.__dict__.copy()
+        state["users"] = 0
+        state["size"] = 0
+        return state
+
+    def estimate_size(self) -> int:
+        """bytes held by the session's text, which is nearly all of it"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.history)
+        for pair in self.history:
+            size += sum(sys.getsizeof(part) for part in pair)
+        conversation = self.conversation
+        if conversation is not None:
+            size += sys.getsizeof(conversation.system)
+            size += sys.getsizeof(conversation.summary)
+            for turn in conversation.turns:
+                size += sys.getsizeof(turn) + sys.getsizeof(turn["content"])
+        return size
+
+
+class SessionStore:
+    """sessions kept on the server and looked up by the id the browser holds.
+
+    The sessions least recently used are pickled to `directory` once all of
+    them together take more than `memory_mb`, and loaded back when their
+    student returns. Sessions in use, or used within `idle_seconds`, are
+    never spilled. Spilled files are written by a background thread and read
+    outside the lock, by `resume` or by `use_async` on a worker thread, and
+    `start` deletes the ones not resumed within `ttl_hours`.
+    """
+
+    def __init__(
+        self,
+        directory: str = SESSION_DIR,
+        memory_mb: float = SESSION_MEMORY_MB,
+        idle_seconds: float = SESSION_IDLE_SECONDS,
+        ttl_hours: float = SESSION_TTL_HOURS,
+    ):
+        self.directory = directory
+        self.budget = int(memory_mb * 1024 * 1024)
+        self.idle_seconds = idle_seconds
+        self.ttl_hours = ttl_hours
+        self.size = 0
+        self.spills = 0
+        self.resumes = 0
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        # sessions taken out of memory whose file is still being written, each
+        # with a token telling the write it is for apart from a later spill
+        self._spilling: dict[str, tuple[Session, object]] = {}
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="session-spill"
+        )
+        self._pruner: threading.Thread | None = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id: str) -> str:
+        return os.path.join(self.directory, f"{session_id}.pickle.z")
+
+    def _load(self, session_id: str) -> Session | None:
+        path = self._path(session_id)
+        try:
+            with open(path, "rb") as f:
+                session = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"Could not resume session {session_id}: {e}")
+            return None
+        os.remove(path)
+        return session
+
+    def _restore(self, session_id: str) -> Session | None:
+        """the session in memory, loaded back from its file if it was spilled"""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                spilling = self._spilling.pop(session_id, None)
+                if spilling is not None:
+                    session = spilling[0]
+                    self.size += session.size
+                    self._sessions[session_id] = session
+            if session is not None:
+                return session
+        # read without the lock, another caller may get there first
+        loaded = self._load(session_id)
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None and loaded is not None:
+                session = loaded
+                session.last_used = time.monotonic()
+                session.size = session.estimate_size()
+                self.size += session.size
+                self._sessions[session_id] = session
+                self.resumes += 1
+            return session
+
+    def _spill(self) -> None:
+        """hands idle sessions to the writer until the rest fit the budget"""
+        now = time.monotonic()
+        for session_id, session in list(self._sessions.items()):
+            if self.size <= self.budget:
+                return
+            if session.users or now - session.last_used < self.idle_seconds:
+                continue
+            del self._sessions[session_id]
+            self.size -= session.size
+            token = object()
+            self._spilling[session_id] = (session, token)
+            self._writer.submit(self._write, session, token)
+
+    def _write(self, session: Session, token: object) -> None:
+        path = self._path(session.id)
+        try:
+            data = zlib.compress(pickle.dumps(session), 1)
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+        except Exception as e:
+            print(f"Could not spill session {session.id}: {e}")
+        with self._lock:
+            if self._spilling.get(session.id, (None, None))[1] is token:
+                del self._spilling[session.id]
+                self.spills += 1
+                return
+        # used or cleared while it was being written, the file is stale
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def resume(self, session_id: str | None) -> str:
+        """the id the browser had when the session can still be found, else a new one"""
+        if session_id and _SESSION_ID.fullmatch(session_id):
+            # loaded now, so the handlers that follow find it in memory
+            if self._restore(session_id) is not None:
+                return session_id
+        return new_session()
+
+    @contextmanager
+    def use(self, session_id: str):
+        """the session, kept in memory while the block runs and accounted after it"""
+        if not _SESSION_ID.fullmatch(session_id or ""):
+            raise ValueError(f"Not a session id: {session_id}")
+        self._restore(session_id)
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = Session(session_id)
+            self._sessions.move_to_end(session_id)
+            session.users += 1
+        try:
+            yield session
+        finally:
+            with self._lock:
+                session.users -= 1
+                session.last_used = time.monotonic()
+                # a session cleared meanwhile is no longer accounted for
+                if self._sessions.get(session_id) is session:
+                    size = session.estimate_size()
+                    self.size += size - session.size
+                    session.size = size
+                if self.size > self.budget:
+                    self._spill()
+
+    @asynccontextmanager
+    async def use_async(self, session_id: str):
+        """`use` for the event loop, reading a spilled session on a worker thread"""
+        with self._lock:
+            in_memory = session_id in self._sessions
+        if not in_memory:
+            await asyncio.to_thread(self._restore, session_id)
+        with self.use(session_id) as session:
+            yield session
+
+    def history(self, session_id: str) -> list[list[str | None]]:
+        with self.use(session_id) as session:
+            return session.history
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self.size -= session.size
+            self._spilling.pop(session_id, None)
+        if _SESSION_ID.fullmatch(session_id or ""):
+            try:
+                os.remove(self._path(session_id))
+            except FileNotFoundError:
+                pass
+
+    def prune(self) -> None:
+        """deletes spilled sessions nobody came back to within the TTL"""
+        cutoff = time.time() - self.ttl_hours * 3600
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def start(self, interval: float = SESSION_PRUNE_INTERVAL) -> None:
+        """starts pruning the spilled sessions in the background, once per process"""
+        if self._pruner is not None:
+            return
+
+        def run():
+            while True:
+                self.prune()
+                time.sleep(interval)
+
+        self._pruner = threading.Thread(target=run, name="session-pruner", daemon=True)
+        self._pruner.start()
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                "in_memory": len(self._sessions),
+                "memory_mb": round(self.size / 1024 / 1024, 2),
+                "budget_mb": round(self.budget / 1024 / 1024, 2),
+                "spills": self.spills,
+                "resumes": self.resumes,
+            }
+
+
+session_store = SessionStore()
@@ -0,0 +1,458 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+
+import gradio as gr
+import numpy as np
+from dotenv import load_dotenv
+
+from utils.assessment import (
+    AssessmentResult,
+    assessment_cache,
+    audio_digest,
+    merge_segments,
+)
+from utils.audio import TARGET_SAMPLE_RATE, Resampler, downmix, prepare, wav_bytes
+from utils.conversation import PronunciationConversation
+from utils.media import media_store
+from utils.metrics import first_audio, span, speech_ended
+from utils.metrics import start as start_metrics
+from utils.resilience import BackendError, open_circuits
+from utils.sessions import session_store
+from utils.speech_backends import backend_for, route
+from utils.speech_backends import warm_up as warm_up_backends
+from utils.stages import StageBusy, stages
+from utils.tts_cache import tts_cache
+from utils.vad import VAD_AUTO_SUBMIT, Endpointer, trim, vad_settings
+
+load_dotenv()
+
+LANGUAGES = ["en-US", "en-GB", "sv-SE", "ja-JP"]
+# "Word" or "Phoneme"; the apps only show word scores, phonemes cost more
+ASSESSMENT_GRANULARITY = os.environ.get("ASSESSMENT_GRANULARITY", "Word")
+
+
+_ready = threading.Event()
+_warm_up_lock = threading.Lock()
+_warm_up_seconds: float | None = None
+_warm_up_error: str | None = None
+_warming: threading.Thread | None = None
+
+
+def _warm_up_backends(on_ready) -> None:
+    global _warm_up_seconds, _warm_up_error
+    start = time.perf_counter()
+    try:
+        warm_up_backends(LANGUAGES)
+    except Exception as e:
+        # not ready: the probe reports the error instead
+        _warm_up_error = f"{type(e).__name__}: {e}"
+        print(f"Warm-up failed: {_warm_up_error}")
+        return
+    finally:
+        _warm_up_seconds = round(time.perf_counter() - start, 2)
+    _ready.set()
+    if on_ready is not None:
+        on_ready()
+
+
+def warm_up(background: bool = False, on_ready=None) -> None:
+    """opens the backends' connections and models, once however many apps ask.
+
+    In the background the server can start while the pools fill up;
+    `readiness` tells when they are done, or why they failed.
+    """
+    global _warming
+    with _warm_up_lock:
+        if _warming is not None:
+            return
+        media_store.spool.start()
+        session_store.start()
+        start_metrics()
+        _warming = threading.Thread(
+            target=_warm_up_backends, args=(on_ready,), name="warm-up", daemon=True
+        )
+        _warming.start()
+    if not background:
+        _warming.join()
+
+
+def readiness() -> dict:
+    """whether the backends are warm, and what is currently holding requests up"""
+    return {
+        "ready": _ready.is_set(),
+        "warm_up_seconds": _warm_up_seconds,
+        "warm_up_error": _warm_up_error,
+        "open_circuits": open_circuits(),
+        "sessions": session_store.stats(),
+        "tts_cache": tts_cache.stats(),
+        "stages": {name: stage.status() for name, stage in stages.items()},
+    }
+
+
+def admit(name: str) -> None:
+    """turns the request away up front when the stage is saturated"""
+    try:
+        stages[name].admit()
+    except StageBusy as e:
+        raise gr.Error(str(e))
+
+
+@asynccontextmanager
+async def stage(name: str, admitted: bool = False):
+    """holds a slot of the stage, telling the student when it is saturated or fails"""
+    try:
+        async with stages[name].slot(admitted):
+            yield
+    except (StageBusy, BackendError) as e:
+        raise gr.Error(str(e))
+
+
+async def staged_stream(name: str, deltas: AsyncIterator[str]) -> AsyncIterator[str]:
+    """passes a stream through while holding a slot of the stage"""
+    async with stage(name):
+        async for delta in deltas:
+            yield delta
+
+
+async def speech_recognize_continuous_from_file(
+    audio: str, language: str, session_id: str | None = None
+) -> str:
+    backend = backend_for("asr", language)
+    tags = {"session_id": session_id, "language": language}
+    with span("audio_prepare", **tags):
+        pcm = await prepare(audio, language)
+    async with stage("asr"):
+        with span("asr", backend=backend.name, **tags):
+            return await backend.recognize(pcm, language)
+
+
+def _float(data: np.ndarray) -> np.ndarray:
+    if np.issubdtype(data.dtype, np.integer):
+        return data / float(np.iinfo(data.dtype).max + 1)
+    return data
+
+
+class Listener:
+    """one streamed microphone recording, from the first chunk to the trimmed file.
+
+    Chunks are resampled to 16 kHz mono as one stream. Silence before the
+    speech is held back instead of being sent to the recognizer, the end of
+    the speech is detected with the language's VAD settings, and `finish`
+    may be called by every event that wants the result; the recording is
+    only finalized once. Chunks that arrive after `finish` or `close` are
+    ignored.
+    """
+
+    sample_rate = TARGET_SAMPLE_RATE
+
+    def __init__(self, language: str, transcribe: bool = True):
+        self.language = language
+        self.settings = vad_settings(language)
+        self.endpointer = Endpointer(self.settings, self.sample_rate)
+        self.recognizer = None
+        if transcribe:
+            self.recognizer = backend_for("asr", language).streaming_recognizer(
+                language, self.sample_rate, 1
+            )
+        self._resampler: Resampler | None = None
+        self.chunks: list[np.ndarray] = []
+        self._held: list[np.ndarray] = []
+        self.speech_end: float | None = None
+        self.closed = False
+        self._result: asyncio.Task | None = None
+
+    @property
+    def text(self) -> str:
+        return self.recognizer.text if self.recognizer is not None else ""
+
+    def _hold(self, samples: np.ndarray) -> None:
+        # enough to cover the speech the endpointer is still confirming
+        self._held.append(samples)
+        seconds = self.settings.min_speech + self.settings.padding
+        limit = int(self.sample_rate * seconds)
+        while sum(len(s) for s in self._held[1:]) >= limit:
+            self._held.pop(0)
+
+    def conform(self, data: np.ndarray, sample_rate: int) -> np.ndarray:
+        """the next browser chunk as 16-bit mono, continuing the chunks before it"""
+        if self._resampler is None or self._resampler.sample_rate != sample_rate:
+            self._resampler = Resampler(sample_rate, self.sample_rate)
+        samples = self._resampler.feed(downmix(_float(data)))
+        return (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+
+    def write(self, samples: np.ndarray) -> bool:
+        """takes the next chunk and returns True for the one that ends the speech"""
+        if self.closed or self.endpointer.ended or self._result is not None:
+            return False
+        ended = self.endpointer.feed(samples)
+        if not self.endpointer.speaking:
+            self._hold(samples)
+            return False
+        for chunk in self._held + [samples]:
+            self.chunks.append(chunk)
+            if self.recognizer is not None:
+                self.recognizer.write(chunk.tobytes())
+        self._held.clear()
+        if ended:
+            silence = self.endpointer.silence_frames * self.settings.frame
+            self.speech_end = time.perf_counter() - silence
+        return ended
+
+    async def _finish(self, session_id: str | None) -> tuple[str, str]:
+        speech_ended(session_id, self.speech_end)
+        tags = {"session_id": session_id, "language": self.language}
+        text = ""
+        if self.recognizer is not None:
+            # only the tail of the utterance is left to recognize at this point
+            async with stage("asr"):
+                with span("asr_finalize", backend=route("asr", self.language), **tags):
+                    text = await self.recognizer.finish()
+        with span("audio_encode", **tags):
+            samples = np.concatenate(self.chunks or self._held)
+            trimmed = trim(samples, self.sample_rate, self.settings)
+            data = wav_bytes(trimmed.tobytes(), self.sample_rate)
+            recording = media_store.put(data, ".wav", session_id)
+        return text, recording
+
+    async def finish(self, session_id: str | None) -> tuple[str, str]:
+        """the transcript and the trimmed recording"""
+        if self._result is None:
+            self._result = asyncio.create_task(self._finish(session_id))
+        return await asyncio.shield(self._result)
+
+    async def close(self) -> None:
+        """drops a recording that will not be submitted, ending its recognition"""
+        if self.closed or self._result is not None:
+            return
+        self.closed = True
+        if self.recognizer is not None:
+            await self.recognizer.close()
+
+
+# stops the browser's microphone, as if the student had clicked stop
+STOP_MIC_JS = """
+(...args) => {
+    const buttons = document.querySelectorAll("#microphone button");
+    const stop = [...buttons].find((button) => /stop/i.test(button.textContent));
+    if (stop) stop.click();
+    return args;
+}
+"""
+
+
+def _feed(
+    chunk: tuple[int, np.ndarray], language: str, listener: Listener | None, **kwargs
+) -> tuple[Listener, object]:
+    sample_rate, data = chunk
+    if listener is None:
+        listener = Listener(language, **kwargs)
+    # browsers record at 44.1 or 48 kHz, often in stereo
+    ended = listener.write(listener.conform(data, sample_rate))
+    # a new value of the hidden endpoint component starts the submission
+    endpoint = uuid.uuid4().hex if ended and VAD_AUTO_SUBMIT else gr.update()
+    return listener, endpoint
+
+
+async def listen(
+    chunk: tuple[int, np.ndarray] | None, language: str, listener: Listener | None
+) -> list:
+    """pushes one streamed microphone chunk and returns the transcript so far"""
+    if chunk is None:
+        return [gr.update(), listener, gr.update()]
+    listener, endpoint = _feed(chunk, language, listener)
+    return [listener.text, listener, endpoint]
+
+
+async def record(
+    chunk: tuple[int, np.ndarray] | None, language: str, listener: Listener | None
+) -> list:
+    """like `listen`, for recordings that are only graded and never transcribed"""
+    if chunk is None:
+        return [listener, gr.update()]
+    return list(_feed(chunk, language, listener, transcribe=False))
+
+
+async def start_listening(listener: Listener | None) -> None:
+    """forgets the last recording, so the first chunk of this one starts a listener"""
+    if listener is not None:
+        await listener.close()
+
+
+async def drop_recording(listener: Listener | None) -> Listener | None:
+    """closes the listener of a recording that was cleared.
+
+    Like a finished one it stays in place until the next recording starts,
+    so chunks still on their way do not open a new recognition.
+    """
+    if listener is not None:
+        await listener.close()
+    return listener
+
+
+async def stop_listening(listener: Listener | None, session_id: str | None) -> list:
+    """finishes a streamed recognition, returning the transcript and the recording"""
+    if listener is None:
+        return [gr.update(), gr.update(), None]
+    text, recording = await listener.finish(session_id)
+    return [text, recording, listener]
+
+
+async def finish_recording(listener: Listener | None, session_id: str | None) -> list:
+    if listener is None:
+        return [gr.update(), None]
+    _, recording = await listener.finish(session_id)
+    return [recording, listener]
+
+
+async def synthesize_file(
+    text: str, lang: str, session_id: str | None = None, admitted: bool = False
+) -> str | None:
+    """synthesizes `text` into a new file in the media store.
+
+    `admitted` sentences belong to a reply that was let into the TTS stage
+    with `admit`, and wait for a slot instead of being refused.
+    """
+    backend = backend_for("tts", lang)
+    tags = {"session_id": session_id, "language": lang, "backend": backend.name}
+    async with stage("tts", admitted):
+        with span("tts", chars=len(text), **tags):
+            audio_data = await backend.synthesize(text, lang)
+    if audio_data:
+        with span("audio_encode", **tags):
+            return media_store.put(audio_data, backend.suffix, session_id)
+
+
+def audio_src(file_path: str, session_id: str | None = None) -> str:
+    return media_store.url(file_path, session_id)
+
+
+def play_audio(file_path: str, autoplay: bool = True, session_id: str | None = None):
+    return media_store.player(file_path, autoplay=autoplay, session_id=session_id)
+
+
+async def example_audio(
+    reference_text: str, lang: str, session_id: str | None = None
+) -> str | None:
+    """the path of the audio of an example sentence, synthesized on a cache miss"""
+    backend = backend_for("tts", lang)
+    key = (backend.voice(lang), backend.output_format, reference_text, backend.suffix)
+    tags = {"session_id": session_id, "language": lang, "backend": backend.name}
+
+    # the teacher repeats weak sentences, so most of them are already cached
+    output_path = tts_cache.get(*key)
+    if output_path is None:
+        async with stage("tts"):
+            with span("tts", chars=len(reference_text), **tags):
+                audio_data = await backend.synthesize(reference_text, lang)
+        if not audio_data:
+            return
+        with span("audio_encode", **tags):
+            output_path = await asyncio.to_thread(tts_cache.put, *key, audio_data)
+    return output_path
+
+
+def start_example(
+    conversation: PronunciationConversation,
+    reference_text: str,
+    lang: str,
+    session_id: str | None = None,
+) -> None:
+    """remembers the example for grading and starts synthesizing its audio"""
+    conversation.reference_text = reference_text
+    conversation.example = asyncio.create_task(
+        example_audio(reference_text, lang, session_id)
+    )
+
+
+async def play_example(
+    history: gr.Chatbot,
+    conversation: PronunciationConversation,
+    lang: str,
+    session_id: str | None = None,
+) -> gr.Chatbot:
+    """appends the example audio, which was started while the reply streamed"""
+    if conversation is None or conversation.example is None:
+        return history
+    output_path = await conversation.example
+    if not output_path:
+        return history
+    first_audio(session_id, lang)
+
+    history[-1][1] += "\n\n" + play_audio(output_path)
+    return history
+
+
+async def grade(
+    audio: str,
+    conversation: PronunciationConversation,
+    language: str,
+    granularity: str = ASSESSMENT_GRANULARITY,
+    session_id: str | None = None,
+    on_segment: Callable[[AssessmentResult], None] | None = None,
+) -> AssessmentResult:
+    """assesses a submission once, however many steps of the chain ask for it.
+
+    The recording is assessed segment by segment, so a long passage is graded
+    to the end; `on_segment` gets the result so far after each segment.
+    """
+    if conversation is None:
+        raise gr.Error('Press "Start practice" to get a sentence to read')
+    reference_text = conversation.reference_text
+    if not reference_text:
+        raise gr.Error("There is no example sentence to read yet, please wait for it")
+    name = route("assessment", language)
+    key = (name, audio_digest(audio), reference_text, language, granularity)
+
+    async def assess_submission() -> AssessmentResult:
+        tags = {"session_id": session_id, "language": language}
+        with span("audio_prepare", **tags):
+            pcm = await prepare(audio)
+        backend = backend_for("assessment", language)
+        segments = []
+        async with stage("assessment"):
+            with span("assessment", backend=name, **tags):
+                async for segment in backend.assess_segments(
+                    pcm, reference_text, language, granularity
+                ):
+                    segments.append(segment)
+                    if on_segment is not None:
+                        merged = merge_segments(
+                            reference_text, segments, language, final=False
+                        )
+                        on_segment(AssessmentResult.from_json(reference_text, merged))
+        merged = merge_segments(reference_text, segments, language)
+        return AssessmentResult.from_json(reference_text, merged)
+
+    return await assessment_cache.get(key, assess_submission)
+
+
+async def grade_pronunciation(
+    audio: str,
+    conversation: PronunciationConversation,
+    language: str,
+    session_id: str | None = None,
+) -> AsyncIterator[str]:
+    """yields the assessment so far as JSON each time a segment has been graded"""
+    partial: asyncio.Queue[AssessmentResult | None] = asyncio.Queue()
+    grading = asyncio.create_task(
+        grade(
+            audio,
+            conversation,
+            language,
+            session_id=session_id,
+            on_segment=partial.put_nowait,
+        )
+    )
+    grading.add_done_callback(lambda _: partial.put_nowait(None))
+    try:
+        while (result := await partial.get()) is not None:
+            yield result.json
+        # also when the result came from the cache without any segments
+        yield (await grading).json
+    finally:
+        grading.cancel()
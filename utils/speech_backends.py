@@ -0,0 +1,451 @@
+import asyncio
+import hashlib
+import importlib
+import io
+import json
+import os
+import re
+import threading
+import wave
+from typing import AsyncIterator
+
+import numpy as np
+from dotenv import load_dotenv
+
+from utils.audio import PcmAudio, wav_bytes
+from utils.latency import latency_sampler
+from utils.resilience import guard
+from utils.stages import stages
+
+load_dotenv()
+
+# "<language>=<backend>" pairs, with "*" for every other language
+ASR_BACKENDS = os.environ.get("ASR_BACKENDS", "*=azure")
+TTS_BACKENDS = os.environ.get("TTS_BACKENDS", "*=azure")
+ASSESSMENT_BACKENDS = os.environ.get("ASSESSMENT_BACKENDS", "*=azure")
+
+WHISPER_MODEL = os.environ.get("WHISPER_MODEL", "base")
+WHISPER_COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE", "int8")
+WHISPER_THREADS = int(os.environ.get("WHISPER_THREADS", 4))
+# "<language>=<path to .onnx voice>" pairs for the local TTS
+PIPER_VOICES = os.environ.get("PIPER_VOICES", "")
+
+# seconds the fake backend waits before answering, to stand in for inference;
+# a number or a distribution such as "lognormal:0.3,0.5" (see utils.latency)
+FAKE_SPEECH_LATENCY = os.environ.get("FAKE_SPEECH_LATENCY", "0")
+FAKE_LATENCIES = {
+    task: os.environ.get(f"FAKE_{task.upper()}_LATENCY", FAKE_SPEECH_LATENCY)
+    for task in ("asr", "tts", "assessment")
+}
+
+
+# where the fake backend splits a passage into segments
+_SENTENCE_END = re.compile(r"(?<=[.!?。！？])\s*")
+
+
+def parse_routes(spec: str) -> dict[str, str]:
+    """parses "en-US=local, *=azure" into {"en-US": "local", "*": "azure"}"""
+    routes = {}
+    for item in spec.split(","):
+        if "=" in item:
+            language, name = item.split("=", 1)
+            routes[language.strip()] = name.strip()
+    return routes
+
+
+class BufferedRecognizer:
+    """collects streamed microphone chunks and recognizes them once the recording stops.
+
+    This is the streaming recognizer of backends that can only transcribe
+    whole recordings; there is no partial text while the student is talking.
+    Chunks are 16-bit PCM of a single channel.
+    """
+
+    def __init__(self, backend, language: str, sample_rate: int, channels: int = 1):
+        self.backend = backend
+        self.language = language
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frames = bytearray()
+        self.closed = False
+        self.text = ""
+
+    def write(self, pcm: bytes) -> None:
+        if not self.closed:
+            self.frames += pcm
+
+    async def finish(self) -> str:
+        self.closed = True
+        audio = PcmAudio(bytes(self.frames), self.sample_rate)
+        self.text = await self.backend.recognize(audio, self.language)
+        return self.text
+
+    async def close(self) -> None:
+        self.closed = True
+        self.frames.clear()
+
+
+class SpeechBackend:
+    """recognition, synthesis and pronunciation assessment for some languages.
+
+    Audio to recognize or assess is a WAV file path or PcmAudio held in
+    memory. `synthesize` returns the audio encoded as `output_format`,
+    which is stored with `suffix`, or None when nothing was synthesized. `assess`
+    returns the assessment in the Azure Speech JSON layout, which is what
+    AssessmentResult parses.
+    """
+
+    name = "base"
+    output_format = "wav-16k"
+    suffix = ".wav"
+    # whether a slow call may be duplicated; pointless when requests share a model
+    hedge = True
+
+    def voice(self, language: str) -> str:
+        return f"{self.name}-{language}"
+
+    async def recognize(self, audio: str | PcmAudio, language: str) -> str:
+        raise NotImplementedError(f"{self.name} does not recognize speech")
+
+    async def synthesize(self, text: str, language: str) -> bytes | None:
+        raise NotImplementedError(f"{self.name} does not synthesize speech")
+
+    async def assess(
+        self,
+        audio: str | PcmAudio,
+        reference_text: str,
+        language: str,
+        granularity: str,
+    ) -> str | None:
+        raise NotImplementedError(f"{self.name} does not assess pronunciation")
+
+    async def assess_segments(
+        self,
+        audio: str | PcmAudio,
+        reference_text: str,
+        language: str,
+        granularity: str,
+    ) -> AsyncIterator[str]:
+        """the assessment of each segment of a long recording, as soon as it is done.
+
+        Backends that can only assess a recording at once yield a single
+        segment; utils.assessment.merge_segments aligns and combines them.
+        """
+        yield await self.assess(audio, reference_text, language, granularity)
+
+    def streaming_recognizer(self, language: str, sample_rate: int, channels: int):
+        return BufferedRecognizer(self, language, sample_rate, channels)
+
+    def warm_up(self, languages: list[str]) -> None:
+        pass
+
+
+class LocalBackend(SpeechBackend):
+    """CPU inference: faster-whisper for recognition and piper for synthesis.
+
+    Models are loaded on first use and shared by every session. Inference
+    runs in a worker thread, one request per model at a time, since the
+    models already use every core they are given.
+    """
+
+    name = "local"
+    # piper writes WAV at the sample rate of the voice model
+    output_format = "wav"
+    hedge = False
+
+    def __init__(self):
+        self.voices = parse_routes(PIPER_VOICES)
+        self._whisper = None
+        self._piper = {}
+        self._whisper_lock = threading.Lock()
+        self._piper_lock = threading.Lock()
+
+    def voice(self, language: str) -> str:
+        return os.path.basename(self.voices.get(language, language))
+
+    def _whisper_model(self):
+        if self._whisper is None:
+            # imported here, loading it takes longer than the rest of the app
+            try:
+                from faster_whisper import WhisperModel
+            except ImportError:
+                raise RuntimeError(
+                    "The local recognizer needs `pip install faster-whisper`"
+                ) from None
+            self._whisper = WhisperModel(
+                WHISPER_MODEL,
+                device="cpu",
+                compute_type=WHISPER_COMPUTE_TYPE,
+                cpu_threads=WHISPER_THREADS,
+            )
+        return self._whisper
+
+    def _piper_voice(self, language: str):
+        if language not in self.voices:
+            raise RuntimeError(f"No piper voice is configured for {language}")
+        if language not in self._piper:
+            try:
+                from piper.voice import PiperVoice
+            except ImportError:
+                raise RuntimeError(
+                    "The local synthesizer needs `pip install piper-tts`"
+                ) from None
+            self._piper[language] = PiperVoice.load(self.voices[language])
+        return self._piper[language]
+
+    def _transcribe(self, audio: str | PcmAudio, language: str) -> str:
+        if isinstance(audio, PcmAudio):
+            # faster-whisper takes float samples at 16 kHz
+            audio = audio.samples.astype(np.float32) / 32768
+        with self._whisper_lock:
+            segments, _ = self._whisper_model().transcribe(
+                audio, language=language.split("-")[0], beam_size=1, vad_filter=True
+            )
+            # segments is lazy, decoding happens while it is consumed
+            return "".join(segment.text for segment in segments).strip()
+
+    def _speak(self, text: str, language: str) -> bytes:
+        buffer = io.BytesIO()
+        with self._piper_lock:
+            piper_voice = self._piper_voice(language)
+            with wave.open(buffer, "wb") as f:
+                piper_voice.synthesize(text, f)
+        return buffer.getvalue()
+
+    async def recognize(self, audio: str | PcmAudio, language: str) -> str:
+        text = await stages["asr"].run(self._transcribe, audio, language)
+        print(f"RECOGNIZED (local): {text}")
+        return text
+
+    async def synthesize(self, text: str, language: str) -> bytes | None:
+        return await stages["tts"].run(self._speak, text, language)
+
+    def warm_up(self, languages: list[str]) -> None:
+        for language in languages:
+            try:
+                self._piper_voice(language)
+            except Exception as e:
+                print(f"Could not load the local voice for {language}: {e}")
+
+
+class FakeBackend(SpeechBackend):
+    """answers instantly (or after FAKE_<TASK>_LATENCY) with deterministic output.
+
+    The same input always gives the same transcript, silence of the same
+    length and the same scores, so the apps can be exercised without any
+    credentials or models. The latencies are drawn from a distribution per
+    task, which is what load tests run against.
+    """
+
+    name = "fake"
+    sample_rate = 16000
+
+    def __init__(self, latencies: dict[str, str] = FAKE_LATENCIES):
+        self.latency = {task: latency_sampler(s) for task, s in latencies.items()}
+
+    async def _wait(self, task: str) -> None:
+        seconds = self.latency[task]()
+        if seconds:
+            await asyncio.sleep(seconds)
+
+    @staticmethod
+    def _digest(*parts: str) -> bytes:
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).digest()
+
+    @staticmethod
+    def _audio_digest(audio: str | PcmAudio) -> str:
+        if isinstance(audio, PcmAudio):
+            return hashlib.sha256(audio.data).hexdigest()
+        with open(audio, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    async def recognize(self, audio: str | PcmAudio, language: str) -> str:
+        await self._wait("asr")
+        return f"fake transcript {self._audio_digest(audio)[:8]}"
+
+    async def synthesize(self, text: str, language: str) -> bytes | None:
+        await self._wait("tts")
+        # 60 ms of silence per character
+        n_samples = int(self.sample_rate * 0.06 * len(text))
+        return wav_bytes(bytes(2 * n_samples), self.sample_rate)
+
+    async def assess(
+        self,
+        audio: str | PcmAudio,
+        reference_text: str,
+        language: str,
+        granularity: str,
+    ) -> str | None:
+        await self._wait("assessment")
+        audio_digest = self._audio_digest(audio)
+
+        def score(*parts: str) -> float:
+            return float(60 + self._digest(audio_digest, *parts)[0] % 41)
+
+        words = [
+            {
+                "Word": word,
+                "PronunciationAssessment": {
+                    "AccuracyScore": score(word),
+                    "ErrorType": "None",
+                },
+                "Phonemes": (
+                    [
+                        {
+                            "Phoneme": ch,
+                            "PronunciationAssessment": {
+                                "AccuracyScore": score(word, ch)
+                            },
+                        }
+                        for ch in word
+                    ]
+                    if granularity == "Phoneme"
+                    else []
+                ),
+            }
+            for word in reference_text.split()
+        ]
+        accuracy = sum(w["PronunciationAssessment"]["AccuracyScore"] for w in words)
+        accuracy = accuracy / len(words) if words else 0.0
+        return json.dumps(
+            {
+                "NBest": [
+                    {
+                        "Display": reference_text,
+                        "PronunciationAssessment": {
+                            "AccuracyScore": accuracy,
+                            "FluencyScore": score("fluency"),
+                            "CompletenessScore": 100.0,
+                            "PronScore": accuracy,
+                        },
+                        "Words": words,
+                    }
+                ]
+            }
+        )
+
+    async def assess_segments(
+        self,
+        audio: str | PcmAudio,
+        reference_text: str,
+        language: str,
+        granularity: str,
+    ) -> AsyncIterator[str]:
+        # one segment per sentence, like the pauses a service would split at
+        for sentence in _SENTENCE_END.split(reference_text.strip()):
+            if sentence:
+                yield await self.assess(audio, sentence, language, granularity)
+
+
+class ResilientBackend(SpeechBackend):
+    """calls another backend through the guards of utils.resilience.
+
+    Every call has a deadline, retryable errors are retried, slow calls are
+    hedged and a failing backend is skipped until its circuit closes again.
+    """
+
+    def __init__(self, backend: SpeechBackend):
+        self.backend = backend
+        self.name = backend.name
+        self.output_format = backend.output_format
+        self.suffix = backend.suffix
+        self.hedge = backend.hedge
+
+    def voice(self, language: str) -> str:
+        return self.backend.voice(language)
+
+    async def recognize(self, audio: str | PcmAudio, language: str) -> str:
+        return await guard(self.name, "asr", self.hedge).call(
+            lambda: self.backend.recognize(audio, language)
+        )
+
+    async def synthesize(self, text: str, language: str) -> bytes | None:
+        return await guard(self.name, "tts", self.hedge).call(
+            lambda: self.backend.synthesize(text, language)
+        )
+
+    async def assess(
+        self,
+        audio: str | PcmAudio,
+        reference_text: str,
+        language: str,
+        granularity: str,
+    ) -> str | None:
+        return await guard(self.name, "assessment", self.hedge).call(
+            lambda: self.backend.assess(audio, reference_text, language, granularity)
+        )
+
+    def streaming_recognizer(self, language: str, sample_rate: int, channels: int):
+        # recordings buffered for backends without live recognition go through
+        # the guard; a live stream cannot be replayed, it only gets a deadline
+        own = type(self.backend).streaming_recognizer
+        if own is SpeechBackend.streaming_recognizer:
+            return BufferedRecognizer(self, language, sample_rate, channels)
+        return self.backend.streaming_recognizer(language, sample_rate, channels)
+
+    def assess_segments(
+        self,
+        audio: str | PcmAudio,
+        reference_text: str,
+        language: str,
+        granularity: str,
+    ) -> AsyncIterator[str]:
+        # a recording assessed at once is retried and hedged like any call;
+        # segments already shown cannot be replayed, they only keep the circuit
+        own = type(self.backend).assess_segments
+        if own is SpeechBackend.assess_segments:
+            return super().assess_segments(audio, reference_text, language, granularity)
+        return guard(self.name, "assessment", self.hedge).stream(
+            self.backend.assess_segments(audio, reference_text, language, granularity)
+        )
+
+    def warm_up(self, languages: list[str]) -> None:
+        self.backend.warm_up(languages)
+
+
+# backend name -> "module:class", imported on first use so that an app only
+# loads the SDKs and models of the backends it actually routes to
+BACKEND_CLASSES = {
+    "azure": "utils.azure:AzureBackend",
+    "local": "utils.speech_backends:LocalBackend",
+    "fake": "utils.speech_backends:FakeBackend",
+}
+
+_backends: dict[str, SpeechBackend] = {}
+_backends_lock = threading.Lock()
+
+_routes = {
+    "asr": parse_routes(ASR_BACKENDS),
+    "tts": parse_routes(TTS_BACKENDS),
+    "assessment": parse_routes(ASSESSMENT_BACKENDS),
+}
+
+
+def get_backend(name: str) -> SpeechBackend:
+    with _backends_lock:
+        if name not in _backends:
+            if name not in BACKEND_CLASSES:
+                raise ValueError(f"Unknown speech backend: {name}")
+            module, cls = BACKEND_CLASSES[name].split(":")
+            backend = getattr(importlib.import_module(module), cls)()
+            _backends[name] = ResilientBackend(backend)
+        return _backends[name]
+
+
+def route(task: str, language: str) -> str:
+    """the name of the backend configured for `task` ("asr", "tts" or "assessment")"""
+    routes = _routes[task]
+    return routes.get(language, routes.get("*", "azure"))
+
+
+def backend_for(task: str, language: str) -> SpeechBackend:
+    return get_backend(route(task, language))
+
+
+def warm_up(languages: list[str]) -> None:
+    """loads every backend that serves synthesis, with the languages it serves"""
+    served: dict[str, list[str]] = {}
+    for language in languages:
+        served.setdefault(route("tts", language), []).append(language)
+    for name, names in served.items():
+        get_backend(name).warm_up(names)
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import queue
+import threading
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+
+import azure.cognitiveservices.speech as speechsdk
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SPEECH_POOL_SIZE = int(os.environ.get("SPEECH_POOL_SIZE", 4))
+
+# name -> (SpeechSynthesisOutputFormat member, file suffix)
+OUTPUT_FORMATS = {
+    "ogg-opus-16k": ("Ogg16Khz16BitMonoOpus", ".ogg"),
+    "ogg-opus-24k": ("Ogg24Khz16BitMonoOpus", ".ogg"),
+    "mp3-16k-32kbps": ("Audio16Khz32KBitRateMonoMp3", ".mp3"),
+    "mp3-16k-64kbps": ("Audio16Khz64KBitRateMonoMp3", ".mp3"),
+    "mp3-24k-48kbps": ("Audio24Khz48KBitRateMonoMp3", ".mp3"),
+    "mp3-24k-96kbps": ("Audio24Khz96KBitRateMonoMp3", ".mp3"),
+    "wav-16k": ("Riff16Khz16BitMonoPcm", ".wav"),
+    "wav-24k": ("Riff24Khz16BitMonoPcm", ".wav"),
+}
+SPEECH_OUTPUT_FORMAT = os.environ.get("SPEECH_OUTPUT_FORMAT", "mp3-24k-48kbps")
+
+
+class SpeechClientPool:
+    """keeps speech configs and connected synthesizers alive across requests.
+
+    Configs and synthesizers are keyed by (region, language, voice). At most
+    `max_size` synthesizers are created per key; callers beyond that wait for
+    one to be returned instead of opening another connection.
+    """
+
+    def __init__(self, max_size: int = SPEECH_POOL_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._configs: dict[tuple, speechsdk.SpeechConfig] = {}
+        self._idle: dict[tuple, queue.LifoQueue] = {}
+        self._sizes: dict[tuple, int] = {}
+        # a Connection stops its synthesizer from closing the websocket, so
+        # it has to live as long as the synthesizer itself
+        self._connections: dict[int, speechsdk.Connection] = {}
+
+    @staticmethod
+    def _key(language: str, voice: str | None) -> tuple:
+        return (os.environ.get("SPEECH_REGION"), language, voice)
+
+    def speech_config(
+        self, language: str, voice: str | None = None
+    ) -> speechsdk.SpeechConfig:
+        key = self._key(language, voice)
+        with self._lock:
+            if key not in self._configs:
+                speech_config = speechsdk.SpeechConfig(
+                    subscription=os.environ.get("SPEECH_KEY"),
+                    region=key[0],
+                )
+                speech_config.speech_recognition_language = language
+                if voice:
+                    speech_config.speech_synthesis_voice_name = voice
+                    speech_config.set_speech_synthesis_output_format(
+                        getattr(
+                            speechsdk.SpeechSynthesisOutputFormat,
+                            OUTPUT_FORMATS[SPEECH_OUTPUT_FORMAT][0],
+                        )
+                    )
+                self._configs[key] = speech_config
+            return self._configs[key]
+
+    def _new_synthesizer(
+        self, language: str, voice: str
+    ) -> speechsdk.SpeechSynthesizer:
+        # audio_config=None keeps the audio in memory on the result, so one
+        # synthesizer can serve any number of requests
+        speech_synthesizer = speechsdk.SpeechSynthesizer(
+            speech_config=self.speech_config(language, voice), audio_config=None
+        )
+        connection = speechsdk.Connection.from_speech_synthesizer(speech_synthesizer)
+        connection.open(True)
+        self._connections[id(speech_synthesizer)] = connection
+        return speech_synthesizer
+
+    def acquire(self, language: str, voice: str) -> speechsdk.SpeechSynthesizer:
+        """checks out a connected synthesizer for `voice`, blocking while the key is at capacity"""
+        key = self._key(language, voice)
+        with self._lock:
+            idle = self._idle.setdefault(key, queue.LifoQueue())
+            if idle.empty() and self._sizes.get(key, 0) < self.max_size:
+                self._sizes[key] = self._sizes.get(key, 0) + 1
+                # None is a free slot that has no synthesizer yet
+                idle.put(None)
+
+        speech_synthesizer = idle.get()
+        if speech_synthesizer is not None:
+            return speech_synthesizer
+        try:
+            return self._new_synthesizer(language, voice)
+        except Exception:
+            idle.put(None)
+            raise
+
+    async def acquire_async(
+        self, language: str, voice: str, executor: Executor
+    ) -> speechsdk.SpeechSynthesizer:
+        """`acquire` on `executor`, returning the synthesizer to the pool when the
+        caller is cancelled while the checkout is still blocked waiting for one"""
+        checkout = executor.submit(self.acquire, language, voice)
+        try:
+            return await asyncio.wrap_future(checkout)
+        except asyncio.CancelledError:
+
+            def release_abandoned(checkout: Future) -> None:
+                if not checkout.cancelled() and checkout.exception() is None:
+                    self.release(language, voice, checkout.result())
+
+            checkout.add_done_callback(release_abandoned)
+            raise
+
+    def release(
+        self, language: str, voice: str, speech_synthesizer, discard: bool = False
+    ) -> None:
+        """returns a synthesizer to the pool, or drops it when it may be mid-request"""
+        idle = self._idle[self._key(language, voice)]
+        if not discard:
+            idle.put(speech_synthesizer)
+            return
+        connection = self._connections.pop(id(speech_synthesizer), None)
+        if connection is not None:
+            connection.close()
+        idle.put(None)
+
+    def warm_up(self, voices: dict[str, str]) -> None:
+        """opens one synthesizer connection per (language, voice) ahead of the first request.
+
+        Raises RuntimeError naming the voices whose connection could not be
+        opened, after trying all of them.
+        """
+
+        def open_one(item: tuple[str, str]) -> str | None:
+            language, voice = item
+            try:
+                self.release(language, voice, self.acquire(language, voice))
+            except Exception as e:
+                return f"{voice}: {e}"
+
+        with ThreadPoolExecutor(max_workers=max(len(voices), 1)) as executor:
+            failures = [f for f in executor.map(open_one, voices.items()) if f]
+        if failures:
+            raise RuntimeError(
+                "Could not open speech connections for " + "; ".join(failures)
+            )
+        print(f"Speech connections warmed up for {list(voices.values())}")
+
+
+speech_pool = SpeechClientPool()
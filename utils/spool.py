@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+SPOOL_TTL = float(os.environ.get("SPOOL_TTL", 3600))
+SPOOL_MAX_BYTES = int(os.environ.get("SPOOL_MAX_BYTES", 512 * 1024 * 1024))
+SPOOL_SWEEP_INTERVAL = float(os.environ.get("SPOOL_SWEEP_INTERVAL", 60))
+# files younger than this may still be streaming to a player
+SPOOL_SERVE_GRACE = float(os.environ.get("SPOOL_SERVE_GRACE", 120))
+
+
+@dataclass
+class SpoolEntry:
+    path: str
+    session_id: str | None
+    size: int
+    created: float
+
+
+class AudioSpool:
+    """owns the audio files the apps create and deletes them when they are no longer needed.
+
+    Files are tracked per session and deleted when the session is cleared,
+    once they are older than `ttl`, or oldest first when the spool holds more
+    than `max_bytes`. Files younger than `serve_grace` are never evicted for
+    quota, so a reply is not deleted while its player is still fetching it;
+    a file already being served keeps streaming after it is unlinked anyway.
+    """
+
+    def __init__(
+        self,
+        ttl: float = SPOOL_TTL,
+        max_bytes: int = SPOOL_MAX_BYTES,
+        serve_grace: float = SPOOL_SERVE_GRACE,
+        keep_dirs: list[str] | None = None,
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.serve_grace = serve_grace
+        # directories that are never removed, even when they become empty
+        self.keep_dirs = {os.path.abspath(d) for d in keep_dirs or []}
+        self.deleted = 0
+        self._entries: OrderedDict[str, SpoolEntry] = OrderedDict()
+        self._sessions: dict[str, set[str]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._sweeper: threading.Thread | None = None
+
+    def track(self, path: str, session_id: str | None = None) -> str:
+        path = os.path.abspath(path)
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            return path
+        with self._lock:
+            if path not in self._entries:
+                entry = SpoolEntry(path, session_id, size, time.time())
+                self._entries[path] = entry
+                self._bytes += size
+                if session_id is not None:
+                    self._sessions.setdefault(session_id, set()).add(path)
+        self._enforce_quota()
+        return path
+
+    def _delete(self, path: str) -> None:
+        """forgets and removes `path`; the caller holds the lock"""
+        entry = self._entries.pop(path, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        if entry.session_id in self._sessions:
+            self._sessions[entry.session_id].discard(path)
+            if not self._sessions[entry.session_id]:
+                del self._sessions[entry.session_id]
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        self.deleted += 1
+        # Gradio puts every upload in a directory of its own
+        parent = os.path.dirname(path)
+        if parent not in self.keep_dirs:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                pass
+
+    def release_session(self, session_id: str | None) -> int:
+        with self._lock:
+            paths = list(self._sessions.get(session_id, ()))
+            for path in paths:
+                self._delete(path)
+        return len(paths)
+
+    def _enforce_quota(self) -> None:
+        now = time.time()
+        with self._lock:
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries.values()))
+                if now - oldest.created < self.serve_grace:
+                    break
+                self._delete(oldest.path)
+
+    def sweep(self) -> int:
+        """deletes expired files and enforces the quota, returning how many went"""
+        deleted = self.deleted
+        expiry = time.time() - self.ttl
+        with self._lock:
+            while self._entries:
+                oldest = next(iter(self._entries.values()))
+                if oldest.created > expiry:
+                    break
+                self._delete(oldest.path)
+        self._enforce_quota()
+        return self.deleted - deleted
+
+    def usage(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "files": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "sessions": len(self._sessions),
+                "deleted": self.deleted,
+            }
+
+    def start(self, interval: float = SPOOL_SWEEP_INTERVAL) -> None:
+        """starts the background sweeper, once per process"""
+        if self._sweeper is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                if self.sweep():
+                    print(f"Audio spool: {self.usage()}")
+
+        self._sweeper = threading.Thread(target=run, name="spool-sweeper", daemon=True)
+        self._sweeper.start()
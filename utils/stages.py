@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "<stage>=<requests in flight>" pairs
+STAGE_LIMITS = os.environ.get("STAGE_LIMITS", "asr=8,assessment=8,llm=16,tts=8")
+# requests that may wait for a stage before new ones are turned away
+STAGE_QUEUE_SIZE = int(os.environ.get("STAGE_QUEUE_SIZE", 32))
+# Gradio workers; the stages, not the Gradio queue, do the limiting
+QUEUE_CONCURRENCY = int(os.environ.get("QUEUE_CONCURRENCY", 64))
+# seconds between refreshes of the status shown in the apps
+STATUS_INTERVAL = float(os.environ.get("STATUS_INTERVAL", 2))
+
+STAGE_LABELS = {
+    "asr": "Speech recognition",
+    "assessment": "Pronunciation assessment",
+    "llm": "Teacher",
+    "tts": "Speech synthesis",
+}
+
+
+class StageBusy(Exception):
+    pass
+
+
+class Stage:
+    """one step of a turn with its own concurrency limit and thread pool.
+
+    Up to `limit` requests run at once, up to `max_queue` more wait, and
+    the rest are refused with StageBusy right away instead of piling up.
+    Work that makes several requests, like speaking a reply sentence by
+    sentence, is admitted once and its requests then wait for their turn.
+    Blocking calls of the stage run on its own executor, so a saturated
+    stage cannot take the threads another stage needs.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int = STAGE_QUEUE_SIZE):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self.waiting = 0
+        # moving average of how long a request holds the stage
+        self.avg_seconds = 1.0
+        self._semaphore = asyncio.Semaphore(limit)
+        self.executor = ThreadPoolExecutor(
+            max_workers=limit, thread_name_prefix=f"stage-{name}"
+        )
+
+    def estimated_wait(self) -> float:
+        """seconds a request arriving now would wait for a free slot"""
+        if self.active < self.limit:
+            return 0.0
+        return (self.waiting + 1) * self.avg_seconds / self.limit
+
+    def admit(self) -> None:
+        """raises StageBusy when a request arriving now would be turned away"""
+        if self.active >= self.limit and self.waiting >= self.max_queue:
+            raise StageBusy(
+                f"{STAGE_LABELS.get(self.name, self.name)} is busy, "
+                f"please try again in about {self.estimated_wait():.0f} s"
+            )
+
+    @asynccontextmanager
+    async def slot(self, admitted: bool = False):
+        """a free slot, waiting for one unless the queue is full or `admitted`"""
+        if not admitted:
+            self.admit()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            seconds = time.perf_counter() - start
+            self.avg_seconds = 0.8 * self.avg_seconds + 0.2 * seconds
+
+    async def run(self, fn, *args):
+        """runs a blocking call on the stage's executor"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, fn, *args
+        )
+
+    def status(self) -> dict[str, float]:
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "limit": self.limit,
+            "estimated_wait": round(self.estimated_wait(), 1),
+        }
+
+
+def _limits(spec: str) -> dict[str, int]:
+    limits = {}
+    for item in spec.split(","):
+        if "=" in item:
+            name, limit = item.split("=", 1)
+            limits[name.strip()] = int(limit)
+    return limits
+
+
+stages = {name: Stage(name, limit) for name, limit in _limits(STAGE_LIMITS).items()}
+for _name in STAGE_LABELS:
+    stages.setdefault(_name, Stage(_name, 8))
+
+
+def backpressure() -> str:
+    """one line per stage that is saturated, for the apps' status box"""
+    lines = []
+    for stage in stages.values():
+        if stage.waiting or stage.active >= stage.limit:
+            lines.append(
+                f"{STAGE_LABELS.get(stage.name, stage.name)}: {stage.waiting} waiting, "
+                f"about {stage.estimated_wait():.0f} s"
+            )
+    return "\n\n".join(lines) or "All services are responding normally."
@@ -0,0 +1,149 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+import uuid
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TTS_CACHE_DIR = os.environ.get("TTS_CACHE_DIR", "/tmp/gradio/tts_cache")
+TTS_CACHE_MAX_BYTES = int(os.environ.get("TTS_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# temp files older than this were left behind by a crashed writer
+_STALE_TEMP_SECONDS = 3600
+# an eviction frees some room beyond the limit, so the next miss does not
+# have to scan the directory again
+_EVICT_TO = 0.9
+
+
+def normalize_text(text: str) -> str:
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text)).strip()
+
+
+class TTSCache:
+    """content-addressed cache of synthesized audio shared by every session and worker.
+
+    Entries are files named after hash(voice, output format, normalized text).
+    The file's mtime doubles as its last use, so every process sharing the
+    directory evicts least recently used entries once it exceeds `max_bytes`.
+    Each process keeps a running count of the bytes it has seen and scans
+    the directory in a background thread only when that count says so; the
+    scan also corrects the count for what other processes wrote.
+    """
+
+    def __init__(
+        self, directory: str = TTS_CACHE_DIR, max_bytes: int = TTS_CACHE_MAX_BYTES
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self._bytes = 0
+        self._counted = False
+        self._evicting = False
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, voice: str, output_format: str, text: str, suffix: str) -> str:
+        key = "\0".join([voice, output_format, normalize_text(text)])
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}{suffix}")
+
+    def get(self, voice: str, output_format: str, text: str, suffix: str) -> str | None:
+        path = self.path(voice, output_format, text, suffix)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(
+        self, voice: str, output_format: str, text: str, suffix: str, data: bytes
+    ) -> str:
+        """atomically stores `data` as the entry for `text` and returns its path"""
+        path = self.path(voice, output_format, text, suffix)
+        # a temp file on the same filesystem, so os.replace is atomic
+        temp_path = os.path.join(self.directory, f".tmp-{uuid.uuid4()}{suffix}")
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._bytes += len(data)
+            evict = not self._evicting and (
+                not self._counted or self._bytes > self.max_bytes
+            )
+            self._evicting = self._evicting or evict
+        if evict:
+            threading.Thread(
+                target=self.evict, name="tts-cache-evict", daemon=True
+            ).start()
+        return path
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        now = time.time()
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.startswith(".tmp-"):
+                    if now - stat.st_mtime > _STALE_TEMP_SECONDS:
+                        _remove(entry.path)
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self) -> None:
+        """recounts the directory and deletes the least recently used entries
+        once it holds more than `max_bytes`"""
+        with self._lock:
+            start = self._bytes
+        total, evicted = start, 0
+        try:
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            if total > self.max_bytes:
+                for _, size, path in sorted(entries):
+                    if total <= self.max_bytes * _EVICT_TO:
+                        break
+                    _remove(path)
+                    total -= size
+                    evicted += 1
+        finally:
+            with self._lock:
+                # whatever was put during the scan is not in its total
+                self._bytes = total + self._bytes - start
+                self._counted = True
+                self._evicting = False
+                self.evicted += evicted
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "evicted": self.evicted,
+            }
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+tts_cache = TTSCache()
@@ -0,0 +1,143 @@
+import json
+import os
+from collections import deque
+from dataclasses import dataclass, replace
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# submit the turn as soon as the student stops speaking
+VAD_AUTO_SUBMIT = os.environ.get("VAD_AUTO_SUBMIT", "1") == "1"
+
+
+@dataclass
+class VadSettings:
+    # frames quieter than this (dBFS) are silence
+    silence_db: float = -45.0
+    # while streaming, frames less than this far above the noise floor (dB)
+    # are silence too; the floor is the quietest frame of the last
+    # `noise_window` seconds
+    noise_margin_db: float = 10.0
+    noise_window: float = 3.0
+    # seconds of silence after speech that end the utterance
+    hangover: float = 0.8
+    # seconds of uninterrupted speech needed before an end can be detected
+    min_speech: float = 0.25
+    # seconds of uninterrupted speech that break a silence, so clicks do not
+    min_resume: float = 0.1
+    # seconds of silence kept around the speech when trimming
+    padding: float = 0.15
+    frame: float = 0.02
+
+
+VAD_SETTINGS = {
+    "en-US": VadSettings(),
+    "en-GB": VadSettings(),
+    "sv-SE": VadSettings(),
+    # longer pauses between phrases are common while reading Japanese
+    "ja-JP": VadSettings(hangover=1.1),
+}
+
+# e.g. VAD_OVERRIDES='{"ja-JP": {"hangover": 1.3, "silence_db": -40}}'
+for _language, _fields in json.loads(os.environ.get("VAD_OVERRIDES", "{}")).items():
+    VAD_SETTINGS[_language] = replace(
+        VAD_SETTINGS.get(_language, VadSettings()), **_fields
+    )
+
+
+def vad_settings(language: str) -> VadSettings:
+    return VAD_SETTINGS.get(language, VadSettings())
+
+
+def _mono(samples: np.ndarray) -> np.ndarray:
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    if np.issubdtype(samples.dtype, np.integer):
+        return samples.astype(np.float32) / 32768
+    return samples.astype(np.float32)
+
+
+def frame_db(samples: np.ndarray, frame_length: int) -> np.ndarray:
+    """the level of every whole frame of int16 or float `samples`, in dBFS"""
+    mono = _mono(samples)
+    n_frames = len(mono) // frame_length
+    frames = mono[: n_frames * frame_length].reshape(n_frames, frame_length)
+    rms = np.sqrt(np.mean(frames**2, axis=1))
+    return 20 * np.log10(np.maximum(rms, 1e-10))
+
+
+def trim(samples: np.ndarray, sample_rate: int, settings: VadSettings) -> np.ndarray:
+    """cuts leading and trailing silence, keeping `settings.padding` around speech"""
+    frame_length = max(int(sample_rate * settings.frame), 1)
+    voiced = np.flatnonzero(frame_db(samples, frame_length) > settings.silence_db)
+    if len(voiced) == 0:
+        return samples
+    padding = int(sample_rate * settings.padding)
+    start = max(voiced[0] * frame_length - padding, 0)
+    end = min((voiced[-1] + 1) * frame_length + padding, len(samples))
+    return samples[start:end]
+
+
+class Endpointer:
+    """decides, chunk by chunk, when a student has finished speaking.
+
+    A frame is voiced when it is louder than `silence_db` and than the noise
+    floor plus `noise_margin_db`, so a noisy room does not keep the
+    utterance going; until `noise_window` has passed only `silence_db`
+    applies. Speech starts with `min_speech` of consecutive voiced frames,
+    and after it bursts shorter than `min_resume`, like clicks, count as
+    part of the silence that ends the utterance.
+    """
+
+    def __init__(self, settings: VadSettings, sample_rate: int):
+        self.settings = settings
+        self.frame_length = max(int(sample_rate * settings.frame), 1)
+        self._rest = np.zeros((0,), dtype=np.int16)
+        # the levels of the last `noise_window`, starting from the fixed threshold
+        window = max(int(settings.noise_window / settings.frame), 1)
+        floor = settings.silence_db - settings.noise_margin_db
+        self._levels = deque([floor] * window, maxlen=window)
+        # consecutive voiced frames up to the last one fed
+        self.voiced_frames = 0
+        self.speaking = False
+        self.silence_frames = 0
+        self.ended = False
+
+    @property
+    def noise_db(self) -> float:
+        return min(self._levels)
+
+    def _voiced(self, db: float) -> bool:
+        self._levels.append(db)
+        threshold = self.noise_db + self.settings.noise_margin_db
+        return db > max(self.settings.silence_db, threshold)
+
+    def feed(self, samples: np.ndarray) -> bool:
+        """takes the next int16 chunk and returns True once the utterance is over"""
+        if self.ended:
+            return True
+        if samples.ndim > 1:
+            samples = samples.mean(axis=1).astype(np.int16)
+        samples = np.concatenate([self._rest, samples])
+        db = frame_db(samples, self.frame_length)
+        self._rest = samples[len(db) * self.frame_length :]
+
+        settings = self.settings
+        for level in db:
+            self.voiced_frames = self.voiced_frames + 1 if self._voiced(level) else 0
+            seconds = self.voiced_frames * settings.frame
+            if not self.speaking:
+                self.speaking = seconds >= settings.min_speech
+            elif seconds >= settings.min_resume:
+                self.silence_frames = 0
+            else:
+                self.silence_frames += 1
+            if (
+                self.speaking
+                and self.silence_frames * settings.frame >= settings.hangover
+            ):
+                self.ended = True
+                return True
+        return False
@@ -0,0 +1,145 @@
+import functools
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+from dotenv import load_dotenv
+
+from utils.assessment import WordScore
+
+load_dotenv()
+
+# outside the app directory and /tmp/gradio, which Gradio serves at /file=
+WORD_STORE_PATH = os.environ.get(
+    "WORD_STORE_PATH", os.path.expanduser("~/.local/share/talk/word_scores.db")
+)
+# a word scoring below this is practiced again
+WEAK_WORD_THRESHOLD = float(os.environ.get("WEAK_WORD_THRESHOLD", 80))
+# a word is set aside after this many weak attempts in a row without improving
+WEAK_WORD_MAX_ATTEMPTS = int(os.environ.get("WEAK_WORD_MAX_ATTEMPTS", 3))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS attempts (
+    id INTEGER PRIMARY KEY,
+    student TEXT NOT NULL,
+    language TEXT NOT NULL,
+    word TEXT NOT NULL,
+    accuracy REAL NOT NULL,
+    error_type TEXT,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attempts_by_word
+    ON attempts (student, language, word, id);
+"""
+
+
+@dataclass
+class WordTarget:
+    word: str
+    last: float
+    trend: float
+    attempts: int
+    # weak attempts in a row up to the latest one
+    streak: int
+    # the streak has gone on too long without the score improving
+    stuck: bool = False
+
+
+class WordStore:
+    """every word score of every student, kept in SQLite across restarts.
+
+    The store decides which words a student should practice next, so the
+    teacher only gets a short list of targets instead of every past score.
+    """
+
+    def __init__(
+        self,
+        path: str = WORD_STORE_PATH,
+        threshold: float = WEAK_WORD_THRESHOLD,
+        max_attempts: int = WEAK_WORD_MAX_ATTEMPTS,
+    ):
+        self.threshold = threshold
+        self.max_attempts = max_attempts
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def add(self, student: str, language: str, words: list[WordScore]) -> None:
+        now = time.time()
+        rows = [
+            (student, language, w.word.lower(), w.accuracy, w.error_type, now)
+            for w in words
+        ]
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT INTO attempts "
+                "(student, language, word, accuracy, error_type, created) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def words(self, student: str, language: str) -> list[WordTarget]:
+        """every word the student has tried, with its recent scores"""
+        # only the attempts that can still be part of a streak are needed
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT word, accuracy, attempts FROM ("
+                "  SELECT word, accuracy,"
+                "    ROW_NUMBER() OVER (PARTITION BY word ORDER BY id DESC) AS n,"
+                "    COUNT(*) OVER (PARTITION BY word) AS attempts"
+                "  FROM attempts WHERE student = ? AND language = ?"
+                ") WHERE n <= ? ORDER BY word, n",
+                (student, language, self.max_attempts + 1),
+            ).fetchall()
+
+        recent: dict[str, list[float]] = {}
+        attempts: dict[str, int] = {}
+        for word, accuracy, count in rows:
+            recent.setdefault(word, []).append(accuracy)
+            attempts[word] = count
+
+        targets = []
+        for word, scores in recent.items():
+            streak = 0
+            while streak < len(scores) and scores[streak] < self.threshold:
+                streak += 1
+            trend = scores[0] - scores[1] if len(scores) > 1 else 0.0
+            # scores are newest first, compare with the first of the last tries
+            stuck = (
+                streak >= self.max_attempts
+                and scores[0] <= scores[self.max_attempts - 1]
+            )
+            targets.append(
+                WordTarget(word, scores[0], trend, attempts[word], streak, stuck)
+            )
+        return targets
+
+    def summary(self, student: str, language: str, limit: int = 8) -> str:
+        """the current practice targets, in a few lines for the prompt"""
+        targets = self.words(student, language)
+        weak = [t for t in targets if t.streak and not t.stuck]
+        stuck = [t for t in targets if t.stuck]
+        if not weak and not stuck:
+            return ""
+        lines = []
+        if weak:
+            lines.append("Words to practice next (latest score, change, attempts):")
+            for t in sorted(weak, key=lambda t: t.last)[:limit]:
+                lines.append(f"{t.word}: {t.last:.0f} ({t.trend:+.0f}), {t.attempts}")
+        if stuck:
+            words = ", ".join(t.word for t in stuck[:limit])
+            lines.append(
+                f"Not improving after {self.max_attempts} tries, "
+                f"practice other words for now: {words}"
+            )
+        return "\n".join(lines)
+
+
+@functools.cache
+def word_store() -> WordStore:
+    """the store of this process, opened on first use rather than on import"""
+    return WordStore()